@@ -4,17 +4,239 @@ Supports text and image requests, contextual dialogue, and OpenAI format input/o
 Manual token configuration, no code login required
 """
 
+import os
 import re
 import json
-import random
-import string
 import base64
-import uuid
+import random
+import secrets
 import httpx
-from typing import Optional, List, Dict, Any, Union
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Any, Union, Callable
 from dataclasses import dataclass, field
 from datetime import datetime
 import time
+import importlib.util
+import functools
+import queue
+import threading
+import atexit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Compact JSON helpers for the StreamGenerate hot path (orjson when installed)
+if orjson is not None:
+    def _json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+    
+    def _log_json_dumps(obj: Any) -> str:
+        try:
+            return orjson.dumps(obj, default=str).decode()
+        except TypeError:
+            # Non-string dict keys or out-of-range integers: let the stdlib encoder handle it
+            return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=str)
+    
+    _json_loads = orjson.loads
+else:
+    def _json_dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+    
+    def _log_json_dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=str)
+    
+    _json_loads = json.loads
+
+# httpx only speaks HTTP/2 when the optional h2 package is installed (httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# Pooled client for user-supplied image URLs, shared by all GeminiClient instances
+# (carries no Gemini cookies/headers, so there is no per-user state)
+_FETCH_CLIENT = httpx.Client(
+    http2=HTTP2_AVAILABLE,
+    timeout=httpx.Timeout(30.0, connect=5.0),
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    follow_redirects=True,
+)
+atexit.register(_FETCH_CLIENT.close)
+
+# Precompiled patterns
+_BL_RE = re.compile(r'"cfb2h":"([^"]+)"')
+_DATA_URI_RE = re.compile(r'data:([^;]+);base64,(.+)')
+_CONTRIB_RE = re.compile(r'/contrib_service/[^\s"\']+')
+_PLACEHOLDER_RE = re.compile(r'https?://googleusercontent\.com/(?:image_generation_content|video_gen_chip)/\d+')
+_PLACEHOLDER_WS_RE = re.compile(r'https?://googleusercontent\.com/(?:image_generation_content|video_gen_chip)/\d+\s*')
+_EMPTY_MD_IMG_RE = re.compile(r'!\[.*?\]\(\)')
+_UPLOADED_MD_IMG_RE = re.compile(r'!\[[^\]]*\]\(https://[^)]*googleusercontent\.com/gg/[^)]+\)')
+_UPLOADED_URL_RE = re.compile(r'https://lh3\.googleusercontent\.com/gg/[^\s\)]+')
+_B64_PREFIX_RE = re.compile(r'[A-Za-z0-9+/]{16,}={0,2}')
+_MD_IMG_RE = re.compile(r'!\[([^\]]*)\]\(([^)]+)\)')
+# Size suffix of Google image URLs: =w400, =w400-h300, =s400, =h400 (optionally followed by -flags)
+_SIZE_RE = re.compile(r'=(?:w\d+(?:-h\d+)?|s\d+|h\d+)(?:-[a-zA-Z]+)*$')
+# Static skeleton of the StreamGenerate inner request array (67 slots, mostly null).
+# Fixed slots are prefilled here; _build_request_data fills the per-request ones:
+#   0: [text, 0, null, image_data, null, null, 0]
+#   2: [conversation_id, response_id, choice_id, ...] conversation context
+#   3: SNlM0e token
+#  17: model code
+#  59: session ID
+#  66: [seconds, nanoseconds] timestamp
+_INNER_FIXED = {1: ["zh-CN"], 6: [1], 7: 1, 10: 1, 11: 0, 18: 0, 27: 1, 30: [4], 41: [1], 53: 0, 61: []}
+_INNER_SKELETON = [_INNER_FIXED.get(i) for i in range(67)]
+
+# Bare URL token; the Google image host check is done in the replacement callback,
+# which keeps the scan linear instead of backtracking over the host alternation
+_BARE_URL_RE = re.compile(r'https?://[^\s)]+')
+
+
+# Fallback BL version, used until a request is rejected and the real one is fetched
+DEFAULT_BL = "boq_assistant-bard-web-server_20241209.00_p0"
+# BL fetched from the Gemini page, shared by all clients for the process lifetime
+_fetched_bl: Optional[str] = None
+
+
+@functools.lru_cache(maxsize=32)
+def _model_headers(model_id: str) -> Dict[str, str]:
+    """Model selection request headers (x-goog-ext-525001261-jspb), treat as read-only"""
+    return {
+        "x-goog-ext-525001261-jspb": json.dumps([1, None, None, None, model_id, None, None, 0, [4], None, None, 2], separators=(',', ':')),
+    }
+
+# Upstream statuses worth retrying (rate limited / temporarily unavailable)
+RETRYABLE_STATUS_CODES = (429, 502, 503, 504)
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 30.0
+
+
+def _estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), 0 for empty text"""
+    return max(1, len(text) // 4) if text else 0
+
+
+def _retry_delay(attempt: int, retry_after: str = None) -> float:
+    """Exponential backoff with jitter, honoring a numeric Retry-After header"""
+    if retry_after and retry_after.strip().isdigit():
+        return min(RETRY_MAX_DELAY, float(retry_after))
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt))
+    return delay * (0.5 + random.random() / 2)
+
+
+# Background writer for logs_api.log, keeps disk I/O off the request path
+LOG_FILE = "logs_api.log"
+MEDIA_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "media_cache")
+LOG_MAX_BYTES = 50 * 1024 * 1024  # Rotate a log file to <name>.1 beyond this size
+LOG_RESPONSE_PREVIEW = 4096  # Characters of raw Gemini response kept per log entry
+_log_queue = queue.Queue(maxsize=10000)
+
+
+def enqueue_log(entry: Union[dict, bytes], path: str = LOG_FILE):
+    """Queue a log entry to be appended to path as a JSON line by the background writer
+    
+    entry is a dict, or an already-encoded JSON document (bytes) that is written as is.
+    Never blocks: when the queue is full the oldest entry is dropped.
+    """
+    item = (path, entry)
+    while True:
+        try:
+            _log_queue.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                _log_queue.get_nowait()
+            except queue.Empty:
+                pass
+
+
+# Log path -> file descriptor opened once with O_APPEND, reopened after rotation
+_log_fds: Dict[str, int] = {}
+_log_fds_lock = threading.Lock()
+
+
+def _log_fd(path: str) -> int:
+    """Append fd for path, rotating the file to <name>.1 once it reaches LOG_MAX_BYTES"""
+    fd = _log_fds.get(path)
+    if fd is not None:
+        st = os.fstat(fd)
+        if st.st_size < LOG_MAX_BYTES and st.st_nlink:
+            return fd
+        # Too big, or the file was removed/renamed from outside: continue in a fresh file
+        os.close(fd)
+        del _log_fds[path]
+        if st.st_nlink:
+            os.replace(path, path + ".1")
+    elif os.path.exists(path) and os.path.getsize(path) >= LOG_MAX_BYTES:
+        os.replace(path, path + ".1")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    _log_fds[path] = fd
+    return fd
+
+
+def _write_log_batch(batch: list):
+    """Append (path, entry) log items as compact JSON lines, one write per path"""
+    by_path = {}
+    for path, entry in batch:
+        if isinstance(entry, bytes):
+            # Raw JSON: newlines outside strings are only whitespace, fold onto one line
+            line = entry.decode("utf-8", "replace").replace("\r", " ").replace("\n", " ")
+        else:
+            line = _log_json_dumps(entry)
+        by_path.setdefault(path, []).append(line)
+    for path, lines in by_path.items():
+        try:
+            # backslashreplace: a lone surrogate (accepted by json.loads) must not cost the whole batch
+            data = "".join(line + "\n" for line in lines).encode("utf-8", "backslashreplace")
+            with _log_fds_lock:
+                fd = _log_fd(path)
+                while data:
+                    data = data[os.write(fd, data):]
+        except Exception as e:
+            print(f"[LOG ERROR] Failed to write {path}: {e}")
+
+
+def _log_worker():
+    """Drain the log queue, writing up to 200 entries per batch"""
+    while True:
+        batch = [_log_queue.get()]
+        try:
+            while len(batch) < 200:
+                batch.append(_log_queue.get_nowait())
+        except queue.Empty:
+            pass
+        _write_log_batch(batch)
+
+
+def _flush_log_queue():
+    """Write whatever is still queued (called at interpreter exit)"""
+    batch = []
+    try:
+        while True:
+            batch.append(_log_queue.get_nowait())
+    except queue.Empty:
+        pass
+    if batch:
+        _write_log_batch(batch)
+
+
+threading.Thread(target=_log_worker, name="gemini-log-writer", daemon=True).start()
+atexit.register(_flush_log_queue)
+
+
+def _original_size_url(url: str) -> str:
+    """Rewrite the size suffix of a Google image URL to =s0 (original size)
+    
+    Only the last "=" of the final path segment can start a size suffix, so the
+    suffix is located with rfind and checked with one anchored match.
+    """
+    eq = url.rfind('=', url.rfind('/') + 1)
+    if eq == -1:
+        # No size parameter
+        return url + '=s0'
+    if _SIZE_RE.match(url, eq):
+        return url[:eq] + '=s0'
+    return url
 
 
 class CookieExpiredError(Exception):
@@ -27,28 +249,96 @@ class ImageUploadError(Exception):
     pass
 
 
-@dataclass
+class UpstreamUnavailableError(Exception):
+    """Gemini is failing repeatedly, request rejected without calling upstream"""
+    pass
+
+
+class CircuitBreaker:
+    """
+    Fail fast while Gemini is unavailable
+    
+    closed    -> open      after `threshold` consecutive failures within `window` seconds
+    open      -> half_open after `cooldown` seconds, letting a single probe request through
+    half_open -> closed on probe success, back to open on probe failure
+    """
+    
+    def __init__(self, threshold: int = 5, window: float = 30.0, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.first_failure_at = 0.0
+        self.opened_at = 0.0
+        self.probe_started_at = 0.0
+        self._lock = threading.Lock()
+    
+    def allow(self) -> bool:
+        """Whether a request may be sent upstream"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            now = time.monotonic()
+            if self.state == "open":
+                if now - self.opened_at < self.cooldown:
+                    return False
+                self.state = "half_open"
+                self.probe_started_at = now
+                return True
+            # half_open: only one probe at a time (a stuck probe is replaced after cooldown)
+            if now - self.probe_started_at >= self.cooldown:
+                self.probe_started_at = now
+                return True
+            return False
+    
+    def retry_in(self) -> float:
+        """Seconds until the next probe is allowed"""
+        return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+    
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+    
+    def record_failure(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "half_open":
+                self.state = "open"
+                self.opened_at = now
+                return
+            if not self.failures or now - self.first_failure_at > self.window:
+                self.failures = 0
+                self.first_failure_at = now
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.state = "open"
+                self.opened_at = now
+
+
+@dataclass(slots=True)
 class Message:
     """OpenAI format message"""
     role: str
     content: Union[str, List[Dict[str, Any]]]
 
 
-@dataclass
+@dataclass(slots=True)
 class ChatCompletionChoice:
     index: int
     message: Message
     finish_reason: str = "stop"
 
 
-@dataclass
+@dataclass(slots=True)
 class Usage:
     prompt_tokens: int = 0
     completion_tokens: int = 0
     total_tokens: int = 0
 
 
-@dataclass
+@dataclass(slots=True)
 class ChatCompletionResponse:
     """OpenAI format response"""
     id: str
@@ -107,6 +397,9 @@ class GeminiClient:
         model_ids: dict = None,
         debug: bool = False,
         media_base_url: str = None,
+        track_history: bool = True,
+        dump_responses: bool = False,
+        on_media_saved: Callable[[str, str], None] = None,
     ):
         """
         Initialize client - manual token configuration
@@ -116,21 +409,30 @@ class GeminiClient:
             secure_1psidts: __Secure-1PSIDTS cookie (recommended)
             secure_1psidcc: __Secure-1PSIDCC cookie (recommended)
             snlm0e: SNlM0e token (required, obtained from page source)
-            bl: BL version number (optional, auto-fetch)
+            bl: BL version number (optional, fetched from the page only if the default is rejected)
             cookies_str: Full cookie string (optional, alternative to individual settings)
             push_id: Push ID for image upload (required for image upload)
             model_ids: Model ID mapping {"flash": "xxx", "pro": "xxx", "thinking": "xxx"}
             debug: Whether to print debug information
             media_base_url: Base URL for media files (e.g., http://localhost:8000), used to construct full media access URLs
+            track_history: Whether to keep a local copy of messages for get_history()
+            dump_responses: Whether to append raw StreamGenerate responses to logs_debug_image_response.txt
+            on_media_saved: Called with (media_id, file_path) after a media file is written to the cache
         """
         self.secure_1psid = secure_1psid
         self.secure_1psidts = secure_1psidts
         self.secure_1psidcc = secure_1psidcc
         self.snlm0e = snlm0e
-        self.bl = bl
+        # BL is resolved lazily: the default is used until Gemini rejects it
+        self.bl = bl or _fetched_bl or DEFAULT_BL
+        self._bl_fetched = bool(_fetched_bl) and not bl
         self.push_id = push_id
         self.debug = debug
         self.media_base_url = media_base_url or ""
+        self.track_history = track_history
+        self.dump_responses = dump_responses
+        self.on_media_saved = on_media_saved
+        self._dump_fd = None  # Opened on first dump
         
         # Model ID mapping (used for selecting model in request headers)
         self.model_ids = model_ids or {
@@ -140,7 +442,9 @@ class GeminiClient:
         }
         
         self.session = httpx.Client(
-            timeout=1220.0,
+            http2=HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(1220.0, connect=10.0),
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64, keepalive_expiry=30.0),
             follow_redirects=True,
             headers={
                 "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
@@ -151,6 +455,14 @@ class GeminiClient:
             },
         )
         
+        # Headers for media downloads (built once, reused for every download)
+        self._dl_headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
+            "Accept": "image/webp,image/apng,image/*,*/*;q=0.8",
+            "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
+            "Referer": "https://gemini.google.com/",
+        }
+        
         # Set cookies
         if cookies_str:
             self._set_cookies_from_string(cookies_str)
@@ -161,6 +473,9 @@ class GeminiClient:
             if secure_1psidcc:
                 self.session.cookies.set("__Secure-1PSIDCC", secure_1psidcc, domain=".google.com")
         
+        # Fails fast while Gemini keeps erroring
+        self.breaker = CircuitBreaker()
+        
         # Session context
         self.conversation_id: str = ""
         self.response_id: str = ""
@@ -169,6 +484,8 @@ class GeminiClient:
         
         # Message history
         self.messages: List[Message] = []
+        # OpenAI-format view of messages, kept in step for get_history()
+        self._history_cache: List[Dict] = []
         
         # Validate required parameters
         if not self.snlm0e:
@@ -180,10 +497,6 @@ class GeminiClient:
                 "3. Search for 'SNlM0e' to find something like: \"SNlM0e\":\"xxxxxx\"\n"
                 "4. Copy the value inside the quotes"
             )
-        
-        # Auto-fetch BL
-        if not self.bl:
-            self._fetch_bl()
     
     def _set_cookies_from_string(self, cookies_str: str):
         """Parse from full cookie string"""
@@ -194,36 +507,45 @@ class GeminiClient:
                 self.session.cookies.set(key.strip(), value.strip(), domain=".google.com")
     
     def _fetch_bl(self):
-        """Fetch BL version number"""
+        """Fetch BL version number from the Gemini page (memoized per process)"""
+        global _fetched_bl
+        self._bl_fetched = True
         try:
             resp = self.session.get(self.BASE_URL)
-            match = re.search(r'"cfb2h":"([^"]+)"', resp.text)
+            match = _BL_RE.search(resp.text)
             if match:
-                self.bl = match.group(1)
+                self.bl = _fetched_bl = match.group(1)
             else:
                 # Use default value
-                self.bl = "boq_assistant-bard-web-server_20241209.00_p0"
+                self.bl = DEFAULT_BL
             if self.debug:
                 print(f"[DEBUG] BL: {self.bl}")
         except Exception as e:
-            self.bl = "boq_assistant-bard-web-server_20241209.00_p0"
+            self.bl = DEFAULT_BL
             if self.debug:
                 print(f"[DEBUG] Failed to fetch BL, using default: {e}")
 
 
     
     def _parse_content(self, content: Union[str, List[Dict]]) -> tuple:
-        """Parse OpenAI format content, return (text, images)"""
+        """Parse OpenAI format content, return (text, images)
+        
+        Image "data" is raw bytes for downloaded URLs, otherwise the base64 string
+        """
         if isinstance(content, str):
             return content, []
         
         text_parts = []
         images = []
+        remote_urls = []  # (index in images, url), downloaded concurrently after the loop
+        text_append = text_parts.append
+        image_append = images.append
         
         for item in content:
-            if item.get("type") == "text":
-                text_parts.append(item.get("text", ""))
-            elif item.get("type") == "image_url":
+            item_type = item.get("type")
+            if item_type == "text":
+                text_append(item.get("text", ""))
+            elif item_type == "image_url":
                 # Support two formats: {"url": "..."} or direct string
                 image_url_data = item.get("image_url", {})
                 if isinstance(image_url_data, str):
@@ -236,30 +558,45 @@ class GeminiClient:
                     
                 if url.startswith("data:"):
                     # base64 format: data:image/png;base64,xxxxx
-                    match = re.match(r'data:([^;]+);base64,(.+)', url)
+                    match = _DATA_URI_RE.match(url)
                     if match:
-                        images.append({"mime_type": match.group(1), "data": match.group(2)})
+                        image_append({"mime_type": match.group(1), "data": match.group(2)})
                 elif url.startswith("http://") or url.startswith("https://"):
-                    # URL format, download image
-                    try:
-                        resp = httpx.get(url, timeout=30)
-                        if resp.status_code == 200:
-                            mime = resp.headers.get("content-type", "image/jpeg").split(";")[0]
-                            images.append({"mime_type": mime, "data": base64.b64encode(resp.content).decode()})
-                    except Exception as e:
-                        if self.debug:
-                            print(f"[DEBUG] Failed to download image: {e}")
-                else:
-                    # Might be a pure base64 string (without data: prefix)
-                    try:
-                        # Try decoding to verify if it's valid base64
-                        base64.b64decode(url[:100])  # Only verify the first 100 characters
-                        images.append({"mime_type": "image/png", "data": url})
-                    except:
-                        pass
+                    # URL format, reserve a slot and download below
+                    remote_urls.append((len(images), url))
+                    image_append(None)
+                elif _B64_PREFIX_RE.fullmatch(url[:100]):
+                    # Pure base64 string (without data: prefix), only the first 100 characters are checked
+                    image_append({"mime_type": "image/png", "data": url})
+        
+        if remote_urls:
+            urls = [url for _, url in remote_urls]
+            if len(urls) == 1:
+                fetched = [self._fetch_image(urls[0])]
+            else:
+                with ThreadPoolExecutor(max_workers=min(8, len(urls))) as executor:
+                    fetched = list(executor.map(self._fetch_image, urls))
+            for (slot, _), img in zip(remote_urls, fetched):
+                images[slot] = img
+            # Drop failed downloads
+            images = [img for img in images if img is not None]
         
         return " ".join(text_parts) if text_parts else "", images
     
+    def _fetch_image(self, url: str) -> Optional[Dict]:
+        """Download an image URL, return {"mime_type", "data"} or None on failure"""
+        try:
+            resp = _FETCH_CLIENT.get(url)
+            if resp.status_code == 200:
+                mime = resp.headers.get("content-type", "image/jpeg").split(";")[0]
+                return {"mime_type": mime, "data": resp.content}
+            if self.debug:
+                print(f"[DEBUG] Failed to download image: HTTP {resp.status_code}")
+        except Exception as e:
+            if self.debug:
+                print(f"[DEBUG] Failed to download image: {e}")
+        return None
+    
     def _upload_image(self, image_data: bytes, mime_type: str = "image/jpeg") -> str:
         """
         Upload image to Gemini server
@@ -279,7 +616,7 @@ class GeminiClient:
         
         try:
             upload_url = "https://push.clients6.google.com/upload/"
-            filename = f"image_{random.randint(100000, 999999)}.png"
+            filename = f"image_{secrets.token_hex(3)}.png"
             
             # Headers required by browser
             browser_headers = {
@@ -366,22 +703,26 @@ class GeminiClient:
                 )
             
             if upload_resp.status_code != 200:
-                raise Exception(f"Image data upload failed: {upload_resp.status_code}, Response: {upload_resp.text[:200] if upload_resp.text else '(empty)'}")
+                preview = upload_resp.content[:200].decode("utf-8", "replace") or "(empty)"
+                raise Exception(f"Image data upload failed: {upload_resp.status_code}, Response: {preview}")
             
             # Extract image path from response
             response_text = upload_resp.text
             image_path = None
             
-            # Try to parse JSON
-            try:
-                response_json = json.loads(response_text)
-                image_path = self._extract_image_path(response_json)
-            except json.JSONDecodeError:
-                # If not JSON, try to extract path from text
-                match = re.search(r'/contrib_service/[^\s"\']+', response_text)
-                if match:
+            # Fast path: match the path directly in the raw text (skipped if it is JSON-escaped)
+            if "/contrib_service/" in response_text:
+                match = _CONTRIB_RE.search(response_text)
+                if match and "\\" not in match.group(0):
                     image_path = match.group(0)
             
+            # Fallback: parse JSON and search the decoded structure
+            if image_path is None:
+                try:
+                    image_path = self._extract_image_path(_json_loads(response_text))
+                except json.JSONDecodeError:
+                    pass
+            
             # Verify image path integrity
             if not image_path:
                 raise CookieExpiredError(
@@ -420,20 +761,17 @@ class GeminiClient:
             raise Exception(f"Image upload failed: {e}")
     
     def _extract_image_path(self, data: Any) -> str:
-        """Recursively extract image path from response data"""
-        if isinstance(data, str):
-            if data.startswith("/contrib_service/"):
-                return data
-        elif isinstance(data, dict):
-            for value in data.values():
-                result = self._extract_image_path(value)
-                if result:
-                    return result
-        elif isinstance(data, list):
-            for item in data:
-                result = self._extract_image_path(item)
-                if result:
-                    return result
+        """Extract image path from response data (depth-first, iterative)"""
+        stack = [data]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                if item.startswith("/contrib_service/"):
+                    return item
+            elif isinstance(item, dict):
+                stack.extend(reversed(list(item.values())))
+            elif isinstance(item, list):
+                stack.extend(reversed(item))
         return None
     
     def _build_request_data(self, text: str, images: List[Dict] = None, image_paths: List[str] = None, model: str = None) -> str:
@@ -448,12 +786,13 @@ class GeminiClient:
         if image_paths and len(image_paths) > 0:
             path = image_paths[0]
             mime_type = images[0]["mime_type"] if images else "image/png"
-            filename = f"image_{random.randint(100000, 999999)}.png"
+            filename = f"image_{secrets.token_hex(3)}.png"
             # Build image array structure
             image_data = [[[path, 1, None, mime_type], filename]]
         
-        # Generate unique session ID
-        session_id = str(uuid.uuid4()).upper()
+        # Generate unique session ID (UUID-shaped, uppercase hex)
+        h = secrets.token_hex(16).upper()
+        session_id = f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
         timestamp = int(time.time() * 1000)
         
         # Model mapping: convert model name to Gemini internal model identifier
@@ -469,114 +808,57 @@ class GeminiClient:
                 model_code = [[3]]  # Thinking version
             # flash or other cases keep default [[1]]
         
-        # Build internal JSON array (based on real request format)
-        # First element: [text, 0, null, image_data, null, null, 0]
-        inner_data = [
-            [text, 0, None, image_data, None, None, 0],
-            ["zh-CN"],
-            [conv_id, resp_id, choice_id, None, None, None, None, None, None, ""],
-            self.snlm0e,
-            None,  # Previously "test123", changed to null
-            None,
-            [1],
-            1,
-            None,
-            None,
-            1,
-            0,
-            None,
-            None,
-            None,
-            None,
-            None,
-            model_code,  # Model selection field
-            0,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            1,
-            None,
-            None,
-            [4],
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            [1],
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            None,
-            0,
-            None,
-            None,
-            None,
-            None,
-            None,
-            session_id,
-            None,
-            [],
-            None,
-            None,
-            None,
-            None,
-            [timestamp // 1000, (timestamp % 1000) * 1000000]
-        ]
+        # Build internal JSON array (based on real request format) from the static skeleton
+        inner_data = _INNER_SKELETON.copy()
+        inner_data[0] = [text, 0, None, image_data, None, None, 0]
+        inner_data[2] = [conv_id, resp_id, choice_id, None, None, None, None, None, None, ""]
+        inner_data[3] = self.snlm0e
+        inner_data[17] = model_code  # Model selection field
+        inner_data[59] = session_id
+        inner_data[66] = [timestamp // 1000, (timestamp % 1000) * 1000000]
         
         # Serialize to JSON string
-        inner_json = json.dumps(inner_data, ensure_ascii=False, separators=(',', ':'))
+        inner_json = _json_dumps(inner_data)
         
         # Outer wrapping
         outer_data = [None, inner_json]
-        f_req_value = json.dumps(outer_data, ensure_ascii=False, separators=(',', ':'))
+        f_req_value = _json_dumps(outer_data)
         
         return f_req_value
 
     
-    def _parse_response(self, response_text: str) -> str:
-        """Parse response text - fixed version"""
+    def _parse_response(self, content: bytes) -> str:
+        """Parse raw StreamGenerate response bytes - fixed version"""
         try:
             # Skip prefix and parse line by line
-            lines = response_text.split("\n")
             final_text = ""
+            final_len = 0
             generated_images_set = set()  # Use set for global deduplication
             last_inner_json = None  # Store the last valid inner_json for debugging
+            json_loads = _json_loads
             
-            for line in lines:
+            # Work on bytes: both orjson and json.loads accept them, no full-body decode
+            for line in content.splitlines():
                 line = line.strip()
-                if not line or line.startswith(")]}'"):
+                if not line or line.startswith(b")]}'"):
                     continue
                 
                 # Skip numeric lines (length markers)
                 if line.isdigit():
                     continue
                 
+                # Only wrb.fr frames carry content, skip decoding anything else
+                if b'"wrb.fr"' not in line:
+                    continue
+                
                 try:
-                    data = json.loads(line)
+                    data = json_loads(line)
                     # data is a nested array, data[0] is the actual data
                     if isinstance(data, list) and len(data) > 0 and isinstance(data[0], list):
                         actual_data = data[0]
                         # Check if it's a wrb.fr response
                         if len(actual_data) >= 3 and actual_data[0] == "wrb.fr" and actual_data[2]:
-                            inner_json = json.loads(actual_data[2])
+                            inner_json = json_loads(actual_data[2])
                             last_inner_json = inner_json
                             
                             # Try to extract generated image URLs and merge into global set for deduplication
@@ -588,15 +870,16 @@ class GeminiClient:
                                     print(f"[DEBUG] Extracted {len(imgs)} image URLs from response, current total: {len(generated_images_set)}")
                             
                             # Extract text content
-                            if inner_json and len(inner_json) > 4 and inner_json[4]:
-                                candidates = inner_json[4]
-                                if candidates and len(candidates) > 0:
+                            candidates = inner_json[4] if inner_json and len(inner_json) > 4 else None
+                            if candidates:
+                                if len(candidates) > 0:
                                     candidate = candidates[0]
                                     if candidate and len(candidate) > 1 and candidate[1]:
                                         # candidate[1] is an array, the first element is text
                                         text = candidate[1][0] if isinstance(candidate[1], list) else candidate[1]
-                                        if isinstance(text, str) and len(text) > len(final_text):
+                                        if isinstance(text, str) and len(text) > final_len:
                                             final_text = text
+                                            final_len = len(text)
                                             # Update conversation context
                                             if len(inner_json) > 1 and inner_json[1]:
                                                 if isinstance(inner_json[1], list):
@@ -653,9 +936,8 @@ class GeminiClient:
                 
                 if has_placeholder:
                     # Remove placeholder URLs
-                    cleaned_text = re.sub(r'https?://googleusercontent\.com/(?:image_generation_content|video_gen_chip)/\d+', '', final_text)
-                    cleaned_text = re.sub(r'http://googleusercontent\.com/(?:image_generation_content|video_gen_chip)/\d+', '', cleaned_text)
-                    cleaned_text = re.sub(r'!\[.*?\]\(\)', '', cleaned_text)  # Remove empty image tags
+                    cleaned_text = _PLACEHOLDER_RE.sub('', final_text)
+                    cleaned_text = _EMPTY_MD_IMG_RE.sub('', cleaned_text)  # Remove empty image tags
                     cleaned_text = cleaned_text.strip()
                     if cleaned_text:
                         final_text = cleaned_text + "\n\n" + media_text
@@ -679,11 +961,10 @@ class GeminiClient:
             # Clean placeholder URLs and user-uploaded image URLs in the text
             if final_text:
                 # Clean placeholder URLs
-                final_text = re.sub(r'https?://googleusercontent\.com/(?:image_generation_content|video_gen_chip)/\d+\s*', '', final_text)
-                final_text = re.sub(r'http://googleusercontent\.com/(?:image_generation_content|video_gen_chip)/\d+\s*', '', final_text)
+                final_text = _PLACEHOLDER_WS_RE.sub('', final_text)
                 # Clean user-uploaded image URLs (/gg/ path, not /gg-dl/)
-                final_text = re.sub(r'!\[[^\]]*\]\(https://[^)]*googleusercontent\.com/gg/[^)]+\)', '', final_text)
-                final_text = re.sub(r'https://lh3\.googleusercontent\.com/gg/[^\s\)]+', '', final_text)
+                final_text = _UPLOADED_MD_IMG_RE.sub('', final_text)
+                final_text = _UPLOADED_URL_RE.sub('', final_text)
                 final_text = final_text.strip()
             
             # If it is video generation, add a notice
@@ -801,26 +1082,16 @@ class GeminiClient:
         """
         try:
             # First optimize URL to get high-definition original image (images only)
-            if ("googleusercontent" in url or "ggpht" in url) and not any(ext in url.lower() for ext in ['.mp4', '.webm', 'video']):
-                # Remove existing size parameters, add original size parameter =s0
-                url = re.sub(r'=w\d+(-h\d+)?(-[a-zA-Z]+)*$', '=s0', url)
-                url = re.sub(r'=s\d+(-[a-zA-Z]+)*$', '=s0', url)
-                url = re.sub(r'=h\d+(-[a-zA-Z]+)*$', '=s0', url)
-                # If URL has no size parameter, add =s0
-                if not url.endswith('=s0') and '=' not in url.split('/')[-1]:
-                    url += '=s0'
+            url_lower = url.lower()
+            if ("googleusercontent" in url or "ggpht" in url) and not (".mp4" in url_lower or ".webm" in url_lower or "video" in url_lower):
+                # Replace existing size parameters with original size parameter =s0
+                url = _original_size_url(url)
             
             if self.debug:
                 print(f"[DEBUG] Downloading media (HD): {url[:100]}...")
             
             # Use current session to download (with authenticated cookies)
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
-                "Accept": "image/webp,image/apng,image/*,*/*;q=0.8",
-                "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
-                "Referer": "https://gemini.google.com/",
-            }
-            resp = self.session.get(url, timeout=60.0, headers=headers)
+            resp = self.session.get(url, timeout=60.0, headers=self._dl_headers)
             
             if self.debug:
                 print(f"[DEBUG] Download status: {resp.status_code}, size: {len(resp.content)} bytes")
@@ -838,19 +1109,19 @@ class GeminiClient:
             
             # Detect file type based on content
             content = resp.content
-            if content[:8] == b'\x89PNG\r\n\x1a\n':
+            if content.startswith(b'\x89PNG\r\n\x1a\n'):
                 ext = ".png"
                 mime = "image/png"
-            elif content[:3] == b'\xff\xd8\xff':
+            elif content.startswith(b'\xff\xd8\xff'):
                 ext = ".jpg"
                 mime = "image/jpeg"
-            elif content[:6] in (b'GIF87a', b'GIF89a'):
+            elif content.startswith((b'GIF87a', b'GIF89a')):
                 ext = ".gif"
                 mime = "image/gif"
-            elif content[:4] == b'RIFF' and content[8:12] == b'WEBP':
+            elif content.startswith(b'RIFF') and content[8:12] == b'WEBP':
                 ext = ".webp"
                 mime = "image/webp"
-            elif content[4:8] == b'ftyp' or content[:4] == b'\x00\x00\x00\x1c':
+            elif content[4:8] == b'ftyp' or content.startswith(b'\x00\x00\x00\x1c'):
                 ext = ".mp4"
                 mime = "video/mp4"
             else:
@@ -858,16 +1129,16 @@ class GeminiClient:
                 mime = "image/png"
             
             # Generate unique filename
-            import os
-            media_id = f"gen_{uuid.uuid4().hex[:16]}"
+            media_id = f"gen_{secrets.token_hex(8)}"
             
             # Save to cache directory
-            cache_dir = os.path.join(os.path.dirname(__file__), "media_cache")
-            os.makedirs(cache_dir, exist_ok=True)
-            file_path = os.path.join(cache_dir, media_id + ext)
+            os.makedirs(MEDIA_CACHE_DIR, exist_ok=True)
+            file_path = os.path.join(MEDIA_CACHE_DIR, media_id + ext)
             
             with open(file_path, "wb") as f:
                 f.write(content)
+            if self.on_media_saved:
+                self.on_media_saved(media_id, file_path)
             
             if self.debug:
                 print(f"[DEBUG] Media saved: {file_path}")
@@ -891,20 +1162,15 @@ class GeminiClient:
         - =s400: specify maximum side length
         - =s0 or =w0-h0: original size
         """
-        import re
+        # Fast path: most responses contain no Google image URLs at all
+        if "googleusercontent" not in text and "ggpht" not in text:
+            return text
         
         def optimize_url(url: str) -> str:
             # Match googleusercontent or ggpht image URLs
             if "googleusercontent" not in url and "ggpht" not in url:
                 return url
-            # Remove existing size parameters and add original size parameter
-            url = re.sub(r'=w\d+(-h\d+)?(-[a-zA-Z]+)*$', '=s0', url)
-            url = re.sub(r'=s\d+(-[a-zA-Z]+)*$', '=s0', url)
-            url = re.sub(r'=h\d+(-[a-zA-Z]+)*$', '=s0', url)
-            # If URL has no size parameter, add =s0
-            if not url.endswith('=s0') and '=' not in url.split('/')[-1]:
-                url += '=s0'
-            return url
+            return _original_size_url(url)
         
         # Match Markdown image syntax and plain URLs
         # Markdown: ![alt](url)
@@ -913,13 +1179,13 @@ class GeminiClient:
             url = match.group(2)
             return f"![{alt}]({optimize_url(url)})"
         
-        text = re.sub(r'!\[([^\]]*)\]\(([^)]+)\)', replace_md_img, text)
+        text = _MD_IMG_RE.sub(replace_md_img, text)
         
-        # Match standalone Google image URLs
+        # Match standalone Google image URLs (optimize_url skips non-Google hosts)
         def replace_url(match):
             return optimize_url(match.group(0))
         
-        text = re.sub(r'https?://[^\s\)]+(?:googleusercontent|ggpht)[^\s\)]*', replace_url, text)
+        text = _BARE_URL_RE.sub(replace_url, text)
         
         return text
 
@@ -994,8 +1260,8 @@ class GeminiClient:
         if reset_context:
             self.reset()
         
-        # Process input
-        text_parts = []
+        # Process input (deque: system messages are prepended)
+        text_parts = deque()
         images = []
         
         if messages:
@@ -1022,29 +1288,28 @@ class GeminiClient:
                 elif role == "system":
                     # system messages as pre-instructions (always needed)
                     if isinstance(content, str) and content:
-                        text_parts.insert(0, content)
+                        text_parts.appendleft(content)
                 
-                self.messages.append(Message(role=role, content=content))
+                if self.track_history:
+                    self._add_message(Message(role=role, content=content))
             
             text = "\n\n".join(text_parts)
         elif message:
             text = message
-            self.messages.append(Message(role="user", content=message))
+            if self.track_history:
+                self._add_message(Message(role="user", content=message))
             
             if image:
-                images = [{"mime_type": "image/jpeg", "data": base64.b64encode(image).decode()}]
+                images = [{"mime_type": "image/jpeg", "data": image}]
             elif image_url:
                 if image_url.startswith("data:"):
-                    match = re.match(r'data:([^;]+);base64,(.+)', image_url)
+                    match = _DATA_URI_RE.match(image_url)
                     if match:
                         images = [{"mime_type": match.group(1), "data": match.group(2)}]
                 else:
-                    try:
-                        resp = httpx.get(image_url, timeout=30)
-                        mime = resp.headers.get("content-type", "image/jpeg").split(";")[0]
-                        images = [{"mime_type": mime, "data": base64.b64encode(resp.content).decode()}]
-                    except:
-                        pass
+                    img = self._fetch_image(image_url)
+                    if img:
+                        images = [img]
         else:
             text = ""
         
@@ -1055,31 +1320,40 @@ class GeminiClient:
         return self._send_request(text, images, model)
 
     
+    def _dump_response(self, content: bytes):
+        """Append a raw response body to the debug dump file with a single write"""
+        try:
+            if self._dump_fd is None:
+                self._dump_fd = os.open("logs_debug_image_response.txt", os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            os.write(self._dump_fd, content + b"\n---\n")
+        except OSError as e:
+            print(f"[LOG ERROR] Failed to dump response: {e}")
+    
     def _log_gemini_call(self, request_data: dict, response_text: str, error: str = None):
         """Log Gemini internal call"""
-        import datetime
         log_entry = {
-            "timestamp": datetime.datetime.now().isoformat(),
+            "timestamp": datetime.now().isoformat(),
             "type": "gemini_internal",
             "request": request_data,
             "response_raw": response_text,
             "error": error
         }
-        try:
-            with open("logs_api.log", "a", encoding="utf-8") as f:
-                f.write(json.dumps(log_entry, ensure_ascii=False, indent=2) + "\n---\n")
-        except Exception as e:
-            print(f"[LOG ERROR] Failed to write Gemini log: {e}")
+        enqueue_log(log_entry)
 
     def _send_request(self, text: str, images: List[Dict] = None, model: str = None) -> ChatCompletionResponse:
         """Send request to Gemini"""
+        if not self.breaker.allow():
+            raise UpstreamUnavailableError(
+                f"Gemini is failing repeatedly, request rejected (retry in {self.breaker.retry_in():.0f} seconds)"
+            )
+        
         url = f"{self.BASE_URL}/_/BardChatUi/data/assistant.lamda.BardFrontendService/StreamGenerate"
         
         params = {
             "bl": self.bl,
             "f.sid": "",
             "hl": "zh-CN",
-            "_reqid": str(self.request_count * 100000 + random.randint(10000, 99999)),
+            "_reqid": str(self.request_count * 100000 + secrets.randbelow(90000) + 10000),
             "rt": "c",
         }
         
@@ -1101,8 +1375,10 @@ class GeminiClient:
             else:
                 try:
                     for img in images:
-                        # Decode base64 data
-                        img_data = base64.b64decode(img["data"])
+                        # Image data is raw bytes (downloaded/binary input) or a base64 string
+                        img_data = img["data"]
+                        if not isinstance(img_data, bytes):
+                            img_data = base64.b64decode(img_data)
                         # Upload and get path
                         path = self._upload_image(img_data, img["mime_type"])
                         image_paths.append(path)
@@ -1120,9 +1396,7 @@ class GeminiClient:
         }
         
         # Model selection request headers
-        model_headers = {
-            "x-goog-ext-525001261-jspb": json.dumps([1, None, None, None, model_id, None, None, 0, [4], None, None, 2], separators=(',', ':')),
-        }
+        model_headers = _model_headers(model_id)
         
         # Build log entry
         gemini_request_log = {
@@ -1148,62 +1422,88 @@ class GeminiClient:
         last_error = None
         
         for attempt in range(max_retries):
+            if attempt:
+                # Retries get a fresh, monotonically increasing _reqid
+                params["_reqid"] = str((self.request_count + attempt) * 100000 + secrets.randbelow(90000) + 10000)
             try:
                 resp = self.session.post(url, params=params, data=form_data, headers=model_headers, timeout=60.0)
             
                 if self.debug:
                     print(f"[DEBUG] Response status: {resp.status_code}")
-                    # print(f"[DEBUG] Response content first 500 characters: {resp.text[:500]}")
-                    # Always save full response for debugging
-                    with open("logs_debug_image_response.txt", "a", encoding="utf-8") as f:
-                        f.write(resp.text)
-                        f.write("\n---\n")
-                    print(f"[DEBUG] Full response saved to logs_debug_image_response.txt")
+                if self.dump_responses:
+                    self._dump_response(resp.content)
                 
-                # Log full Gemini response
-                self._log_gemini_call(gemini_request_log, resp.text)
+                body = resp.content
+                self._log_gemini_call(gemini_request_log, body[:LOG_RESPONSE_PREVIEW].decode("utf-8", "replace"))
                 
                 resp.raise_for_status()
+                self.breaker.record_success()
                 self.request_count += 1
                 
-                reply_text = self._parse_response(resp.text)
+                reply_text = self._parse_response(body)
                 
-                # Save assistant reply
-                self.messages.append(Message(role="assistant", content=reply_text))
+                # Save assistant reply (same instance is returned in the response)
+                reply_message = Message(role="assistant", content=reply_text)
+                if self.track_history:
+                    self._add_message(reply_message)
                 
                 # Build OpenAI format response
+                now = int(time.time())
+                prompt_tokens = _estimate_tokens(text)
+                completion_tokens = _estimate_tokens(reply_text)
                 return ChatCompletionResponse(
-                    id=f"chatcmpl-{self.conversation_id or 'gemini'}-{int(time.time())}",
-                    created=int(time.time()),
+                    id=f"chatcmpl-{self.conversation_id or 'gemini'}-{now}",
+                    created=now,
                     model="gemini-web",
                     choices=[
                         ChatCompletionChoice(
                             index=0,
-                            message=Message(role="assistant", content=reply_text),
+                            message=reply_message,
                             finish_reason="stop"
                         )
                     ],
                     usage=Usage(
-                        prompt_tokens=len(text),
-                        completion_tokens=len(reply_text),
-                        total_tokens=len(text) + len(reply_text)
+                        prompt_tokens=prompt_tokens,
+                        completion_tokens=completion_tokens,
+                        total_tokens=prompt_tokens + completion_tokens
                     )
                 )
                 
             except httpx.HTTPStatusError as e:
-                self._log_gemini_call(gemini_request_log, e.response.text if hasattr(e, 'response') else "", error=f"HTTP {e.response.status_code}")
-                raise Exception(f"HTTP error: {e.response.status_code}")
+                if e.response.status_code == 400 and not self._bl_fetched and attempt < max_retries - 1:
+                    # Possibly a stale BL version: fetch the current one once and retry
+                    self._fetch_bl()
+                    params["bl"] = self.bl
+                    continue
+                if e.response.status_code in RETRYABLE_STATUS_CODES and attempt < max_retries - 1:
+                    last_error = e
+                    wait_time = _retry_delay(attempt, e.response.headers.get("retry-after"))
+                    print(f"⚠️  HTTP {e.response.status_code}, retrying after {wait_time:.1f} seconds ({attempt + 1}/{max_retries})...")
+                    time.sleep(wait_time)
+                    continue
+                # Server errors, rate limiting and expired auth count against the breaker;
+                # other client errors mean Gemini itself is reachable
+                status = e.response.status_code
+                if status >= 500 or status in (401, 403, 429):
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                self._log_gemini_call(gemini_request_log, e.response.text[:LOG_RESPONSE_PREVIEW], error=f"HTTP {status}")
+                raise Exception(f"HTTP error: {status}")
             except (httpx.RemoteProtocolError, httpx.ReadError, httpx.ConnectError) as e:
                 # Network connection issues, retryable
                 last_error = e
                 if attempt < max_retries - 1:
-                    wait_time = (attempt + 1) * 2  # 2, 4 seconds
-                    print(f"⚠️  Connection interrupted, retrying after {wait_time} seconds ({attempt + 1}/{max_retries})...")
+                    wait_time = _retry_delay(attempt)
+                    print(f"⚠️  Connection interrupted, retrying after {wait_time:.1f} seconds ({attempt + 1}/{max_retries})...")
                     time.sleep(wait_time)
                     continue
+                self.breaker.record_failure()
                 self._log_gemini_call(gemini_request_log, "", error=str(e))
                 raise Exception(f"Network connection failed (retried {max_retries} times): {e}")
             except Exception as e:
+                if isinstance(e, httpx.TransportError):
+                    self.breaker.record_failure()
                 self._log_gemini_call(gemini_request_log, "", error=str(e))
                 raise Exception(f"Request failed: {e}")
         
@@ -1211,16 +1511,35 @@ class GeminiClient:
         if last_error:
             raise Exception(f"Request failed (retried {max_retries} times): {last_error}")
     
+    def close(self):
+        """Close underlying HTTP connections"""
+        self.session.close()
+        if self._dump_fd is not None:
+            os.close(self._dump_fd)
+            self._dump_fd = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
     def reset(self):
         """Reset session context"""
         self.conversation_id = ""
         self.response_id = ""
         self.choice_id = ""
         self.messages = []
+        self._history_cache = []
+    
+    def _add_message(self, message: Message):
+        """Record a message in history"""
+        self.messages.append(message)
+        self._history_cache.append({"role": message.role, "content": message.content})
     
     def get_history(self) -> List[Dict]:
         """Get message history (OpenAI format)"""
-        return [{"role": m.role, "content": m.content} for m in self.messages]
+        return list(self._history_cache)
 
 
 # OpenAI compatible interface
@@ -5,21 +5,36 @@ push-id is a necessary parameter for image uploads, in the format feeds/xxxxx
 It needs to be obtained from the Gemini page or API
 """
 
+import atexit
 import httpx
 import re
+from importlib.util import find_spec
 from config import SECURE_1PSID, SECURE_1PSIDTS, SECURE_1PSIDCC, COOKIES_STR
 
+# push-id patterns, tried in order of preference against the lowercased page
+# (push-ids are lowercase, so this matches what re.IGNORECASE would)
+_PUSH_ID_PATTERNS = [re.compile(p) for p in (
+    r'"push[_-]?id["\s:]+["\'](feeds/[a-z0-9]+)["\']',  # "push_id": "feeds/xxx"
+    r'push[_-]?id["\s:=]+["\'](feeds/[a-z0-9]+)["\']',  # push_id="feeds/xxx"
+    r'feedname["\s:]+["\'](feeds/[a-z0-9]+)["\']',      # "feedName": "feeds/xxx"
+    r'clientid["\s:]+["\'](feeds/[a-z0-9]+)["\']',      # "clientId": "feeds/xxx"
+    r'(feeds/[a-z0-9]{14,})',                           # Directly match feeds/xxx format
+)]
+_FEED_ID_RE = re.compile(r'feeds/[a-z0-9]{14,}')
 
-def get_push_id_from_page():
-    """Get push-id from Gemini page"""
-    print("Getting push-id...")
-    
+# httpx only speaks HTTP/2 when the optional h2 package is installed (httpx[http2])
+HTTP2_AVAILABLE = find_spec("h2") is not None
+
+
+def _create_session() -> httpx.Client:
+    """Create the pooled client shared by the page and API lookups"""
     session = httpx.Client(
+        http2=HTTP2_AVAILABLE,
         timeout=30.0,
         follow_redirects=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
         headers={
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
             "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
         }
     )
@@ -38,29 +53,44 @@ def get_push_id_from_page():
         if SECURE_1PSIDCC:
             session.cookies.set("__Secure-1PSIDCC", SECURE_1PSIDCC, domain=".google.com")
     
+    return session
+
+
+# Created on first use and kept for the later lookups
+_SESSION = None
+
+
+def _get_session() -> httpx.Client:
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = _create_session()
+        atexit.register(_SESSION.close)
+    return _SESSION
+
+
+def get_push_id_from_page():
+    """Get push-id from Gemini page"""
+    print("Getting push-id...")
+    
     try:
         # Access Gemini homepage
-        resp = session.get("https://gemini.google.com")
+        resp = _get_session().get(
+            "https://gemini.google.com",
+            headers={"Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8"},
+        )
         
         if resp.status_code != 200:
             print(f"❌ Access failed: {resp.status_code}")
             return None
         
         html = resp.text
+        html_lower = html.lower()
         
         # Try multiple patterns to match push-id
-        patterns = [
-            r'"push[_-]?id["\s:]+["\'](feeds/[a-z0-9]+)["\']',  # "push_id": "feeds/xxx"
-            r'push[_-]?id["\s:=]+["\'](feeds/[a-z0-9]+)["\']',  # push_id="feeds/xxx"
-            r'feedName["\s:]+["\'](feeds/[a-z0-9]+)["\']',      # "feedName": "feeds/xxx"
-            r'clientId["\s:]+["\'](feeds/[a-z0-9]+)["\']',      # "clientId": "feeds/xxx"
-            r'(feeds/[a-z0-9]{14,})',                           # Directly match feeds/xxx format
-        ]
-        
-        for pattern in patterns:
-            matches = re.findall(pattern, html, re.IGNORECASE)
-            if matches:
-                push_id = matches[0]
+        for pattern in _PUSH_ID_PATTERNS:
+            match = pattern.search(html_lower)
+            if match:
+                push_id = match.group(1)
                 print(f"✅ 找到 push-id: {push_id}")
                 return push_id
         
@@ -82,25 +112,6 @@ def get_push_id_from_api():
     """Try to get push-id from API"""
     print("\nTrying to get push-id from API...")
     
-    session = httpx.Client(
-        timeout=30.0,
-        follow_redirects=True,
-        headers={
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-            "Content-Type": "application/json",
-        }
-    )
-    
-    # Set cookies
-    if COOKIES_STR:
-        for item in COOKIES_STR.split(";"):
-            item = item.strip()
-            if "=" in item:
-                key, value = item.split("=", 1)
-                session.cookies.set(key.strip(), value.strip(), domain=".google.com")
-    else:
-        session.cookies.set("__Secure-1PSID", SECURE_1PSID, domain=".google.com")
-    
     # Possible API endpoints
     endpoints = [
         "https://gemini.google.com/_/BardChatUi/data/batchexecute",
@@ -109,12 +120,12 @@ def get_push_id_from_api():
     
     for endpoint in endpoints:
         try:
-            resp = session.get(endpoint)
+            resp = _get_session().get(endpoint, headers={"Content-Type": "application/json"})
             print(f"  {endpoint}: {resp.status_code}")
             if resp.status_code == 200:
                 # Try to extract push-id from response
                 text = resp.text
-                match = re.search(r'feeds/[a-z0-9]{14,}', text)
+                match = _FEED_ID_RE.search(text)
                 if match:
                     push_id = match.group(0)
                     print(f"  ✅ Found: {push_id}")
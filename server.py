@@ -8,30 +8,181 @@ API:   http://localhost:8000/v1
 
 from fastapi import FastAPI, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, JSONResponse
-from pydantic import BaseModel
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, JSONResponse, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ConfigDict, ValidationError
 from typing import List, Dict, Any, Optional, Union
 import uvicorn
+import asyncio
+import anyio
 import time
-import uuid
+import heapq
+import itertools
+import gzip
+from contextlib import asynccontextmanager
+from collections import deque, OrderedDict
 import json
 import os
 import re
 import httpx
 import hashlib
+import hmac
 import secrets
+import threading
+import traceback
+import atexit
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+from client import GeminiClient, UpstreamUnavailableError, HTTP2_AVAILABLE, enqueue_log
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# JSON helpers for tool calls, SSE chunks and the config file (orjson when installed)
+if orjson is not None:
+    _json_loads = orjson.loads
+    
+    def _json_dumps_bytes(obj: Any) -> bytes:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # Integers beyond 64 bits or lone surrogates (json.loads accepts both): stdlib, ASCII-escaped
+            return json.dumps(obj, separators=(',', ':')).encode("ascii")
+    
+    def _json_dumps(obj: Any) -> str:
+        return _json_dumps_bytes(obj).decode()
+    
+    def _json_dumps_pretty(obj: Any) -> bytes:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+        except TypeError:
+            # Same cases as _json_dumps_bytes: let the stdlib encoder handle it
+            return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+else:
+    _json_loads = json.loads
+    
+    def _json_dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+    
+    def _json_dumps_bytes(obj: Any) -> bytes:
+        return _json_dumps(obj).encode("utf-8")
+    
+    def _json_dumps_pretty(obj: Any) -> bytes:
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+
+# 19+ digit runs may be integers outside orjson's 64-bit range, which it would turn into floats
+_LONG_DIGITS_RE = re.compile(r"[0-9]{19}")
+_LONG_DIGITS_BYTES_RE = re.compile(rb"[0-9]{19}")
+
+
+def _json_loads_exact(data: Union[str, bytes]) -> Any:
+    """
+    Decode untrusted JSON (request bodies, model output) exactly as json.loads would, with orjson when it can
+    orjson is skipped for input with long numbers and retried with json.loads when it rejects the input
+    (e.g. lone surrogate escapes like "\\ud800", which json accepts).
+    """
+    if orjson is not None:
+        long_digits = _LONG_DIGITS_BYTES_RE if isinstance(data, bytes) else _LONG_DIGITS_RE
+        if not long_digits.search(data):
+            try:
+                return orjson.loads(data)
+            except ValueError:
+                pass
+    return json.loads(data)
 
 # ============ Configuration ============
 API_KEY = "sk-gemini"
 HOST = "0.0.0.0"
 PORT = 8000
 CONFIG_FILE = "config_data.json"
+RAW_REQUEST_LOG_FILE = "logs_raw_requests.log"
 # Admin login credentials
 ADMIN_USERNAME = "admin"
 ADMIN_PASSWORD = "admin123"
+# Max concurrent upstream Gemini calls (the shared client keeps per-conversation state)
+UPSTREAM_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "1"))
+# Max upstream Gemini calls per minute (0 = unlimited)
+UPSTREAM_RPM = int(os.getenv("GEMINI_RPM", "0"))
+# Media cache limits: files older than MEDIA_MAX_AGE_HOURS are removed, then least recently
+# accessed files until the cache is under MEDIA_MAX_BYTES; checked every MEDIA_CLEANUP_INTERVAL seconds
+MEDIA_MAX_AGE_HOURS = 1
+MEDIA_MAX_BYTES = int(os.getenv("GEMINI_MEDIA_MAX_BYTES", str(500 * 1024 * 1024)))
+MEDIA_CLEANUP_INTERVAL = 600
+# Record every chat completion (request, response or error) in the API log file (GEMINI_API_LOG=0 disables it)
+API_LOG_ENABLED = os.getenv("GEMINI_API_LOG", "1") != "0"
+# Flush config saves to disk before the rename (GEMINI_CONFIG_FSYNC=0 skips it, e.g. on slow network disks)
+CONFIG_FSYNC = os.getenv("GEMINI_CONFIG_FSYNC", "1") != "0"
+# Print per-request session and tool result details to the console
+DEBUG_MSG_LOG = os.getenv("GEMINI_DEBUG", "") == "1"
+# Max characters of message text replayed to Gemini per request, older middle turns are dropped (0 = unlimited)
+HISTORY_MAX_CHARS = int(os.getenv("GEMINI_HISTORY_MAX_CHARS", str(128 * 1024)))
+# Streamed replies up to this many characters are sent as a single write
+SSE_COALESCE_MAX_SIZE = 16 * 1024
 # ========================================
 
-app = FastAPI(title="Gemini OpenAI API", version="1.0.0")
+_upstream_sem = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
+
+
+class RpmLimiter:
+    """Sliding-window requests-per-minute limiter for upstream calls"""
+
+    def __init__(self, rpm: int, window: float = 60.0):
+        self.rpm = rpm
+        self.window = window
+        self._stamps = deque()
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        """Wait until a call fits in the window, then record it"""
+        if self.rpm <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                while self._stamps and now - self._stamps[0] >= self.window:
+                    self._stamps.popleft()
+                if len(self._stamps) < self.rpm:
+                    break
+                await asyncio.sleep(self.window - (now - self._stamps[0]))
+            self._stamps.append(now)
+
+
+_rpm_limiter = RpmLimiter(UPSTREAM_RPM)
+
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson when it is installed (stdlib fallback for what orjson rejects)"""
+
+    def render(self, content: Any) -> bytes:
+        if orjson is None:
+            return super().render(content)
+        return _json_dumps_bytes(content)
+
+
+async def _media_cleanup_loop():
+    """Periodically enforce the media cache limits"""
+    while True:
+        try:
+            await run_in_threadpool(cleanup_old_media, MEDIA_MAX_AGE_HOURS, MEDIA_MAX_BYTES)
+        except Exception as e:
+            # Keep the timer alive, the next sweep may succeed
+            print(f"[MEDIA] Cache cleanup failed: {e}")
+        await asyncio.sleep(MEDIA_CLEANUP_INTERVAL)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    cleanup_task = asyncio.create_task(_media_cleanup_loop())
+    yield
+    cleanup_task.cancel()
+
+
+app = FastAPI(title="Gemini OpenAI API", version="1.0.0", default_response_class=FastJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -44,62 +195,239 @@ app.add_middleware(
 # Static file routes (for sample images)
 from fastapi.responses import FileResponse
 
+
+class ZeroCopyFileResponse(FileResponse):
+    """
+    FileResponse that hands the open file to the server for sendfile() when it implements the
+    ASGI http.response.zerocopysend extension. Everything else (no extension, pathsend offered,
+    HEAD, Range requests) is served by FileResponse itself, through its public ASGI entry point.
+    """
+    
+    async def __call__(self, scope, receive, send):
+        extensions = scope.get("extensions") or {}
+        if (scope["type"] != "http" or scope.get("method") != "GET"
+                or "http.response.zerocopysend" not in extensions
+                or "http.response.pathsend" in extensions  # FileResponse uses pathsend itself
+                or any(name == b"range" for name, _ in scope.get("headers", ()))):
+            return await super().__call__(scope, receive, send)
+        # Opened in a worker thread so a slow disk does not stall the event loop
+        file = await anyio.to_thread.run_sync(open, self.path, "rb")
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            await send({"type": "http.response.zerocopysend", "file": file, "more_body": False})
+        finally:
+            file.close()
+        if self.background is not None:
+            await self.background()
+
+# Directory of this file: static files (sample image) are served from here
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Only image files may be served from it (it also holds the code, config and logs)
+STATIC_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".svg", ".ico")
+
 # Generated media file cache directory
-MEDIA_CACHE_DIR = os.path.join(os.path.dirname(__file__), "media_cache")
+MEDIA_CACHE_DIR = os.path.join(MODULE_DIR, "media_cache")
 os.makedirs(MEDIA_CACHE_DIR, exist_ok=True)
+MEDIA_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".mp4")
+_MEDIA_ID_RE = re.compile(r'[A-Za-z0-9_\-]{1,64}')  # Generated IDs are gen_ + 16 hex digits
+
+# media_id -> file path, rebuilt from the directory when it has changed since the last scan
+_media_index: Dict[str, str] = {}
+_media_index_mtime = None
+
+def _refresh_media_index():
+    """Rescan the media cache directory if its mtime changed (files added/removed)"""
+    global _media_index, _media_index_mtime
+    try:
+        mtime = os.stat(MEDIA_CACHE_DIR).st_mtime_ns
+        if mtime == _media_index_mtime:
+            return
+        index = {}
+        with os.scandir(MEDIA_CACHE_DIR) as entries:
+            for entry in entries:
+                stem, ext = os.path.splitext(entry.name)
+                if ext in MEDIA_EXTENSIONS:
+                    index[stem] = entry.path
+    except OSError:
+        return
+    _media_index = index
+    # Timestamps are coarse: a file added in the same tick would not change mtime, so only
+    # trust an mtime that is at least a second old (otherwise rescan on the next miss)
+    _media_index_mtime = mtime if time.time_ns() - mtime > 1_000_000_000 else None
+
+def _file_response(request: Request, file_path: str) -> Optional[Response]:
+    """Serve a file with ETag/Last-Modified, 304 if the client copy is current, None if there is no such file"""
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    headers = {
+        "ETag": f'"{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}"',
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+        "Cache-Control": "public, max-age=3600",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        not_modified = if_none_match.strip() == "*" or headers["ETag"] in if_none_match
+    else:
+        not_modified = False
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                not_modified = int(st.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                pass
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    return ZeroCopyFileResponse(file_path, headers=headers, stat_result=st)
 
 @app.get("/static/{filename}")
-async def serve_static(filename: str):
+async def serve_static(filename: str, request: Request):
     """Serve static files (sample images, etc.)"""
-    file_path = os.path.join(os.path.dirname(__file__), filename)
-    if os.path.exists(file_path):
-        return FileResponse(file_path)
+    # Plain image file names only: no separators, no hidden files or parent references
+    if ("/" in filename or "\\" in filename or filename.startswith(".")
+            or not filename.lower().endswith(STATIC_EXTENSIONS)):
+        raise HTTPException(status_code=404, detail="File not found")
+    file_path = f"{MODULE_DIR}/{filename}"
+    response = _file_response(request, file_path)
+    if response is not None:
+        return response
     raise HTTPException(status_code=404, detail="File not found")
 
 @app.get("/media/{media_id}")
-async def serve_media(media_id: str):
+async def serve_media(media_id: str, request: Request):
     """Serve cached media files"""
-    # Security check: only allow alphanumeric and underscores
-    if not media_id.replace("_", "").replace("-", "").isalnum():
+    # Security check: only allow ASCII alphanumerics, underscores and hyphens (bounded length)
+    if not _MEDIA_ID_RE.fullmatch(media_id):
         raise HTTPException(status_code=400, detail="Invalid media ID")
     
-    # Find matching file
-    for ext in [".png", ".jpg", ".jpeg", ".gif", ".webp", ".mp4"]:
-        file_path = os.path.join(MEDIA_CACHE_DIR, media_id + ext)
-        if os.path.exists(file_path):
-            return FileResponse(file_path)
+    # Find matching file, rescanning only on a miss
+    file_path = _media_index.get(media_id)
+    if file_path is None:
+        _refresh_media_index()
+        file_path = _media_index.get(media_id)
+    if file_path is not None:
+        response = _file_response(request, file_path)
+        if response is not None:
+            return response
+        _media_index.pop(media_id, None)
     
     raise HTTPException(status_code=404, detail="Media file not found")
 
-def cleanup_old_media(max_age_hours: int = 1):
-    """Clean up expired media cache files"""
-    import time
+def _register_media(media_id: str, path: str):
+    """Index a media file as soon as the client has written it, so serving it needs no rescan"""
+    _media_index[media_id] = path
+
+# Directory fd based scan/unlink where the platform has it (not on Windows)
+_MEDIA_DIR_FD_SUPPORTED = (hasattr(os, "O_DIRECTORY") and os.scandir in os.supports_fd
+                           and os.unlink in os.supports_dir_fd)
+
+def _remove_media(name: str, dir_fd: Optional[int]):
+    """Delete a cached media file by name (ignoring files already gone) and drop it from the index"""
+    try:
+        if dir_fd is not None:
+            os.unlink(name, dir_fd=dir_fd)
+        else:
+            os.remove(os.path.join(MEDIA_CACHE_DIR, name))
+    except OSError:
+        pass
+    _media_index.pop(os.path.splitext(name)[0], None)
+
+def cleanup_old_media(max_age_hours: int = 1, max_bytes: int = None):
+    """Clean up expired media cache files, then evict least recently accessed files over max_bytes"""
     now = time.time()
     max_age_seconds = max_age_hours * 3600
     
+    dir_fd = None
+    if _MEDIA_DIR_FD_SUPPORTED:
+        try:
+            # Scan, stat and unlink relative to one directory fd: no per-file path lookup from the root
+            dir_fd = os.open(MEDIA_CACHE_DIR, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError:
+            return  # Cache directory missing or unreadable
     try:
-        for filename in os.listdir(MEDIA_CACHE_DIR):
-            file_path = os.path.join(MEDIA_CACHE_DIR, filename)
-            if os.path.isfile(file_path):
-                file_age = now - os.path.getmtime(file_path)
-                if file_age > max_age_seconds:
-                    os.remove(file_path)
-    except Exception:
-        pass
-
-# Store valid session tokens
-_admin_sessions = set()
+        kept = []  # (last access, size, name) of files that survive the age check
+        total = 0
+        try:
+            # DirEntry carries the file type and caches stat(), one syscall per file
+            with os.scandir(MEDIA_CACHE_DIR if dir_fd is None else dir_fd) as entries:
+                for entry in entries:
+                    try:
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue  # Removed while scanning
+                    if now - st.st_mtime > max_age_seconds:
+                        _remove_media(entry.name, dir_fd)
+                    else:
+                        # atime may be coarse (relatime/noatime), never older than the write
+                        kept.append((max(st.st_atime, st.st_mtime), st.st_size, entry.name))
+                        total += st.st_size
+        except OSError:
+            return  # Cache directory missing or unreadable
+        
+        if max_bytes is not None and total > max_bytes:
+            # Pop only as many oldest entries as needed instead of sorting everything
+            heapq.heapify(kept)
+            while kept and total > max_bytes:
+                _, size, name = heapq.heappop(kept)
+                _remove_media(name, dir_fd)
+                total -= size
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+
+# Session tokens are "expiry.nonce.signature", signed with SESSION_SECRET so no server-side
+# session table is needed. Set GEMINI_SESSION_SECRET to keep sessions valid across restarts.
+SESSION_SECRET = os.getenv("GEMINI_SESSION_SECRET", "").encode("utf-8") or secrets.token_bytes(32)
+SESSION_TTL = 86400  # Matches the admin_session cookie max_age
+# Logged out tokens -> expiry (unix time), in revocation order, kept only until they would
+# have expired anyway. Every token lives at most SESSION_TTL, so the oldest entry is always
+# the next to expire or close to it: pruning pops from the front instead of scanning
+_revoked_sessions: "OrderedDict[str, int]" = OrderedDict()
+
+def _secret_equals(given: Any, expected: str) -> bool:
+    """Constant-time comparison for credentials and keys"""
+    return secrets.compare_digest(str(given).encode("utf-8"), expected.encode("utf-8"))
+
+def _session_signature(payload: str) -> str:
+    return hmac.new(SESSION_SECRET, payload.encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+
+def _session_expiry(token: str) -> Optional[int]:
+    """Expiry of a correctly signed token, None if the token is malformed or forged"""
+    payload, _, signature = token.rpartition(".")
+    expiry, _, nonce = payload.partition(".")
+    if not nonce or not (expiry.isascii() and expiry.isdigit()):
+        return None
+    # Compared as bytes: compare_digest rejects str with non-ASCII characters
+    if not hmac.compare_digest(signature.encode("utf-8"), _session_signature(payload).encode("utf-8")):
+        return None
+    return int(expiry)
 
 def generate_session_token():
-    """Generate random session token"""
-    return secrets.token_hex(32)
+    """Generate a signed session token valid for SESSION_TTL seconds"""
+    payload = f"{int(time.time()) + SESSION_TTL}.{secrets.token_urlsafe(12)}"
+    return f"{payload}.{_session_signature(payload)}"
+
+def revoke_session_token(token: str):
+    """Reject a token from now on (logout)"""
+    now = int(time.time())
+    while _revoked_sessions and next(iter(_revoked_sessions.values())) <= now:
+        _revoked_sessions.popitem(last=False)
+    expiry = _session_expiry(token)
+    if expiry is not None and expiry > now:
+        _revoked_sessions[token] = expiry
 
 def verify_admin_session(request: Request):
     """Verify admin session"""
     token = request.cookies.get("admin_session")
-    if not token or token not in _admin_sessions:
+    if not token:
         return False
-    return True
+    expiry = _session_expiry(token)
+    return expiry is not None and expiry > time.time() and token not in _revoked_sessions
 
 # Default available models list (Gemini 3 official three models: Flash/Thinking/Pro)
 DEFAULT_MODELS = ["gemini-3.0-flash", "gemini-3.0-flash-thinking", "gemini-3.0-pro"]
@@ -138,6 +466,18 @@ COOKIE_FIELD_MAP = {
     "SSID": "SSID",
     "APISID": "APISID",
 }
+# Config fields filled from the parsed cookie
+COOKIE_CONFIG_FIELDS = ("SECURE_1PSID", "SECURE_1PSIDTS", "SAPISID", "SID", "HSID", "SSID", "APISID")
+# Longest FULL_COOKIE accepted by the admin panel (real Google cookie headers are a few KB)
+COOKIE_MAX_LENGTH = 16384
+
+
+def iter_cookie_pairs(cookie_str: str):
+    """Yield (name, unstripped value) for each name=value item of a cookie string"""
+    for item in cookie_str.split(";"):
+        key, sep, value = item.partition("=")
+        if sep:
+            yield key.strip(), value
 
 
 def parse_cookie_string(cookie_str: str) -> dict:
@@ -146,105 +486,164 @@ def parse_cookie_string(cookie_str: str) -> dict:
     if not cookie_str:
         return result
     
-    for item in cookie_str.split(";"):
-        item = item.strip()
-        if "=" in item:
-            eq_index = item.index("=")
-            key = item[:eq_index].strip()
-            value = item[eq_index + 1:].strip()
-            if key in COOKIE_FIELD_MAP:
-                result[COOKIE_FIELD_MAP[key]] = value
+    for key, value in iter_cookie_pairs(cookie_str):
+        field = COOKIE_FIELD_MAP.get(key)
+        # First occurrence wins (the browser lists the most specific cookie first)
+        if field and field not in result:
+            result[field] = value.strip()
     
     return result
 
 
-def fetch_tokens_from_page(cookies_str: str) -> dict:
-    """Automatically fetch SNLM0E, PUSH_ID and available models list from Gemini page"""
-    result = {"snlm0e": "", "push_id": "", "models": []}
-    try:
-        session = httpx.Client(
+# Patterns for scraping tokens and model info from the Gemini page
+_SNLM0E_PATTERNS = [
+    re.compile(r'"SNlM0e":"([^"]+)"'),
+    re.compile(r'SNlM0e["\s:]+["\']([^"\']+)["\']'),
+    re.compile(r'"at":"([^"]+)"'),
+]
+_PUSH_ID_PATTERNS = [
+    re.compile(r'"push[_-]?id["\s:]+["\'](feeds/[a-z0-9]+)["\']', re.IGNORECASE),
+    re.compile(r'push[_-]?id["\s:=]+["\'](feeds/[a-z0-9]+)["\']', re.IGNORECASE),
+    re.compile(r'feedName["\s:]+["\'](feeds/[a-z0-9]+)["\']', re.IGNORECASE),
+    re.compile(r'clientId["\s:]+["\'](feeds/[a-z0-9]+)["\']', re.IGNORECASE),
+]
+# Last resort: any long feed id (not part of the alternation, it overlaps the keyed patterns)
+_PUSH_ID_FALLBACK_RE = re.compile(r'(feeds/[a-z0-9]{14,})', re.IGNORECASE)
+_MODEL_PATTERNS = [
+    re.compile(r'"(gemini-[a-z0-9\.\-]+)"', re.IGNORECASE),  # Match "gemini-xxx" format
+    re.compile(r"'(gemini-[a-z0-9\.\-]+)'", re.IGNORECASE),  # Match 'gemini-xxx' format
+]
+
+
+def _combine_patterns(patterns: List[re.Pattern]) -> re.Pattern:
+    """One alternation of single-group patterns (same flags), so the text is scanned once;
+    the matching alternative is m.lastindex (1-based, in list order)"""
+    return re.compile("|".join(f"(?:{p.pattern})" for p in patterns), patterns[0].flags)
+
+
+def _first_by_priority(pattern: re.Pattern, text: str) -> Optional[str]:
+    """Group of the first match of the earliest alternative that matches anywhere in text"""
+    found = {}
+    for m in pattern.finditer(text):
+        if m.lastindex == 1:
+            return m.group(1)
+        found.setdefault(m.lastindex, m.group(m.lastindex))
+    return found[min(found)] if found else None
+
+
+_SNLM0E_RE = _combine_patterns(_SNLM0E_PATTERNS)
+_PUSH_ID_RE = _combine_patterns(_PUSH_ID_PATTERNS)
+_MODEL_RE = _combine_patterns(_MODEL_PATTERNS)
+_MODEL_KIND_RE = re.compile(r'flash|pro|ultra|nano', re.IGNORECASE)
+_MODEL_ID_RE = re.compile(r'\["([a-f0-9]{16})","gemini[^"]*(?:flash|pro|thinking)[^"]*"\]', re.IGNORECASE)
+_HEX_ID_RE = re.compile(r'"([a-f0-9]{16})"')
+_MODEL_CONTEXT_KEYWORDS = ("gemini", "model", "flash", "pro", "thinking")
+_MODEL_CONTEXT_RADIUS = 100
+
+
+# Client for fetching the Gemini page, created on first use and kept for later calls.
+# Its cookie jar is per call, so calls are serialized by the lock.
+_token_fetch_client: Optional[httpx.Client] = None
+_token_fetch_lock = threading.Lock()
+
+
+def _get_token_fetch_client() -> httpx.Client:
+    global _token_fetch_client
+    if _token_fetch_client is None:
+        _token_fetch_client = httpx.Client(
+            http2=HTTP2_AVAILABLE,
             timeout=30.0,
             follow_redirects=True,
+            # Calls are serialized, one idle connection is enough. Keep it longer than httpx's
+            # 5s default so consecutive admin saves skip the TLS handshake (drops are retried)
+            limits=httpx.Limits(max_keepalive_connections=1, keepalive_expiry=120.0),
             headers={
                 "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
                 "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
                 "Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
             }
         )
-        
-        # 设置 cookies
-        for item in cookies_str.split(";"):
-            item = item.strip()
-            if "=" in item:
-                key, value = item.split("=", 1)
-                session.cookies.set(key.strip(), value.strip(), domain=".google.com")
-        
-        resp = session.get("https://gemini.google.com")
+        atexit.register(_token_fetch_client.close)
+    return _token_fetch_client
+
+
+def _reset_token_fetch_client():
+    """Drop the pooled page client so the next call builds a fresh one"""
+    global _token_fetch_client
+    if _token_fetch_client is not None:
+        atexit.unregister(_token_fetch_client.close)
+        try:
+            _token_fetch_client.close()
+        except Exception:
+            pass
+        _token_fetch_client = None
+
+
+def fetch_tokens_from_page(cookies_str: str) -> dict:
+    """Automatically fetch SNLM0E, PUSH_ID and available models list from Gemini page"""
+    result = {"snlm0e": "", "push_id": "", "models": []}
+    try:
+        with _token_fetch_lock:
+            for attempt in range(2):
+                session = _get_token_fetch_client()
+                # 设置 cookies (clear first: the jar also keeps Set-Cookie values from earlier calls)
+                session.cookies.clear()
+                for key, value in iter_cookie_pairs(cookies_str):
+                    session.cookies.set(key, value.strip(), domain=".google.com")
+                
+                try:
+                    resp = session.get("https://gemini.google.com")
+                    break
+                except (httpx.RemoteProtocolError, httpx.CloseError):
+                    # A kept-alive connection was dropped by the server, retry once on a new client
+                    if attempt:
+                        raise
+                    _reset_token_fetch_client()
         if resp.status_code != 200:
             return result
         
         html = resp.text
         
         # 获取 SNLM0E (AT Token)
-        snlm0e_patterns = [
-            r'"SNlM0e":"([^"]+)"',
-            r'SNlM0e["\s:]+["\']([^"\']+)["\']',
-            r'"at":"([^"]+)"',
-        ]
-        for pattern in snlm0e_patterns:
-            match = re.search(pattern, html)
-            if match:
-                result["snlm0e"] = match.group(1)
-                break
+        result["snlm0e"] = _first_by_priority(_SNLM0E_RE, html) or ""
         
         # 获取 PUSH_ID
-        push_id_patterns = [
-            r'"push[_-]?id["\s:]+["\'](feeds/[a-z0-9]+)["\']',
-            r'push[_-]?id["\s:=]+["\'](feeds/[a-z0-9]+)["\']',
-            r'feedName["\s:]+["\'](feeds/[a-z0-9]+)["\']',
-            r'clientId["\s:]+["\'](feeds/[a-z0-9]+)["\']',
-            r'(feeds/[a-z0-9]{14,})',
-        ]
-        for pattern in push_id_patterns:
-            matches = re.findall(pattern, html, re.IGNORECASE)
-            if matches:
-                result["push_id"] = matches[0]
-                break
+        push_id = _first_by_priority(_PUSH_ID_RE, html)
+        if push_id is None:
+            match = _PUSH_ID_FALLBACK_RE.search(html)
+            push_id = match.group(1) if match else ""
+        result["push_id"] = push_id
         
         # Get available models list (extract gemini model IDs from page)
-        model_patterns = [
-            r'"(gemini-[a-z0-9\.\-]+)"',  # Match "gemini-xxx" format
-            r"'(gemini-[a-z0-9\.\-]+)'",  # Match 'gemini-xxx' format
-        ]
         models_found = set()
-        for pattern in model_patterns:
-            matches = re.findall(pattern, html, re.IGNORECASE)
-            for m in matches:
-                # Filter valid model names
-                if any(x in m.lower() for x in ['flash', 'pro', 'ultra', 'nano']):
-                    models_found.add(m)
+        for match in _MODEL_RE.finditer(html):
+            m = match.group(match.lastindex)
+            # Filter valid model names
+            if _MODEL_KIND_RE.search(m):
+                models_found.add(m)
         
         if models_found:
             result["models"] = sorted(list(models_found))
         
         # Get model IDs (for x-goog-ext-525001261-jspb request header)
         # These IDs are used to select different model versions
-        model_id_pattern = r'\["([a-f0-9]{16})","gemini[^"]*(?:flash|pro|thinking)[^"]*"\]'
-        model_ids = re.findall(model_id_pattern, html, re.IGNORECASE)
+        model_ids = _MODEL_ID_RE.findall(html)
         if model_ids:
             result["model_ids"] = list(set(model_ids))
         
         # Fallback: directly search for 16-digit hex IDs (near model configuration)
         if not result.get("model_ids"):
-            # Search for patterns like "56fdd199312815e2"
-            hex_id_pattern = r'"([a-f0-9]{16})"'
-            # Search within context containing gemini or model
-            context_pattern = r'.{0,100}(?:gemini|model|flash|pro|thinking).{0,100}'
-            contexts = re.findall(context_pattern, html, re.IGNORECASE)
+            # Search for patterns like "56fdd199312815e2" with gemini/model keywords within 100 chars
+            html_lower = html.lower()
             hex_ids = set()
-            for ctx in contexts:
-                ids = re.findall(hex_id_pattern, ctx)
-                hex_ids.update(ids)
+            for m in _HEX_ID_RE.finditer(html):
+                hex_id = m.group(1)
+                if hex_id in hex_ids:
+                    # Already accepted: the page repeats config IDs, skip slicing another window
+                    continue
+                window = html_lower[max(0, m.start() - _MODEL_CONTEXT_RADIUS):m.end() + _MODEL_CONTEXT_RADIUS]
+                if any(k in window for k in _MODEL_CONTEXT_KEYWORDS):
+                    hex_ids.add(hex_id)
             if hex_ids:
                 result["model_ids"] = list(hex_ids)
         
@@ -252,20 +651,53 @@ def fetch_tokens_from_page(cookies_str: str) -> dict:
     except Exception:
         return result
 
+
+# Successful page token fetches, sha256(cookie) -> (monotonic fetch time, tokens)
+_token_cache: Dict[str, tuple] = {}
+TOKEN_CACHE_TTL = 600
+
+
+def fetch_tokens_cached(cookies_str: str, force: bool = False) -> dict:
+    """fetch_tokens_from_page, reusing a recent successful result for the same cookie"""
+    key = hashlib.sha256(cookies_str.encode("utf-8")).hexdigest()
+    now = time.monotonic()
+    cached = _token_cache.get(key)
+    if cached and not force and now - cached[0] < TOKEN_CACHE_TTL:
+        return cached[1]
+    
+    tokens = fetch_tokens_from_page(cookies_str)
+    # Drop expired entries, cache only usable results
+    for k in [k for k, (ts, _) in _token_cache.items() if now - ts >= TOKEN_CACHE_TTL]:
+        del _token_cache[k]
+    if tokens.get("snlm0e"):
+        _token_cache[key] = (now, tokens)
+    return tokens
+
 _client = None
 
 
 # ============ Tools Support ============
+# Tool call block patterns, each with a literal every match contains.
+# Kept as separate scans: fenced blocks can share a fence, so one alternation would not match the same blocks
+_TOOL_CALL_PATTERNS = [
+    (re.compile(r'```tool_call\s*\n?(.*?)\n?```', re.DOTALL), "```tool_call"),  # ```tool_call ... ```
+    (re.compile(r'```json\s*\n?(.*?)\n?```', re.DOTALL), "```json"),        # ```json ... ``` (sometimes models use this)
+    (re.compile(r'```\s*\n?(\{[^`]*"name"[^`]*\})\n?```', re.DOTALL), '"name"'),  # ``` {...} ```
+]
+# Bare JSON tool call object (without code block wrapper)
+_JSON_TOOL_RE = re.compile(r'\{[^{}]*"name"\s*:\s*"[^"]+"\s*,\s*"arguments"\s*:\s*\{[^{}]*\}[^{}]*\}', re.DOTALL)
+
+
 def build_tools_prompt(tools: List[Dict]) -> str:
     """Convert tools definition to prompt"""
     if not tools:
         return ""
     
-    tools_schema = json.dumps([{
+    tools_schema = _json_dumps([{
         "name": t["function"]["name"],
         "description": t["function"].get("description", ""),
         "parameters": t["function"].get("parameters", {})
-    } for t in tools if t.get("type") == "function"], ensure_ascii=False, indent=2)
+    } for t in tools if t.get("type") == "function"])
     
     prompt = f"""[System] You have access to these functions. Use them when needed to accomplish the user's request:
 
@@ -285,6 +717,49 @@ User request: """
     return prompt
 
 
+# Recently built tool prompts, blake2b(canonical tools JSON) -> prompt, least recently used first
+_tools_prompt_cache: "OrderedDict[str, str]" = OrderedDict()
+TOOLS_PROMPT_CACHE_MAX = 64
+
+
+def build_tools_prompt_cached(tools: List[Dict], tool_models: Optional[List[BaseModel]] = None) -> str:
+    """
+    build_tools_prompt, reusing the prompt when the same tool schema is sent again
+    tools (e.g. as sent by the client) only keys the cache when tool_models is given;
+    the prompt is then built from the models, which are dumped only on a miss.
+    """
+    if not tools:
+        return ""
+    canonical = None
+    if orjson is not None:
+        try:
+            canonical = orjson.dumps(tools, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            pass  # Integers beyond 64 bits or lone surrogates, see _json_dumps_bytes
+    if canonical is None:
+        canonical = json.dumps(tools, sort_keys=True, separators=(',', ':')).encode("utf-8")
+    key = hashlib.blake2b(canonical, digest_size=16).hexdigest()
+    
+    prompt = _tools_prompt_cache.get(key)
+    if prompt is not None:
+        _tools_prompt_cache.move_to_end(key)
+        return prompt
+    prompt = build_tools_prompt([t.model_dump() for t in tool_models] if tool_models is not None else tools)
+    _tools_prompt_cache[key] = prompt
+    if len(_tools_prompt_cache) > TOOLS_PROMPT_CACHE_MAX:
+        _tools_prompt_cache.popitem(last=False)
+    return prompt
+
+
+# Tool call IDs: a random per-process prefix plus a counter, unique without reading the OS RNG per call
+_TOOL_CALL_ID_PREFIX = secrets.token_hex(4)
+_tool_call_counter = itertools.count()
+
+
+def _next_tool_call_id() -> str:
+    return f"call_{_TOOL_CALL_ID_PREFIX}{next(_tool_call_counter):08x}"
+
+
 def parse_tool_calls(content: str) -> tuple:
     """
     Parse tool calls in response
@@ -292,84 +767,183 @@ def parse_tool_calls(content: str) -> tuple:
     """
     tool_calls = []
     
-    # Multiple matching patterns
-    patterns = [
-        r'```tool_call\s*\n?(.*?)\n?```',  # ```tool_call ... ```
-        r'```json\s*\n?(.*?)\n?```',        # ```json ... ``` (sometimes models use this)
-        r'```\s*\n?(\{[^`]*"name"[^`]*\})\n?```',  # ``` {...} ```
-    ]
+    # Every pattern needs a ```tool_call/```json fence or a "name" key: plain replies
+    # (including ones with ordinary code blocks) skip all regex work
+    if '"name"' not in content and "```tool_call" not in content and "```json" not in content:
+        return tool_calls, content.strip()
     
+    # Patterns are tried in order of preference, the first one that matches wins.
+    # Patterns whose required literal is absent are skipped without a regex scan.
+    # One finditer per pattern: the spans of the winning pattern's blocks are kept to cut them out
     matches = []
-    for pattern in patterns:
-        found = re.findall(pattern, content, re.DOTALL)
-        matches.extend(found)
+    spans = []
+    for pattern, marker in _TOOL_CALL_PATTERNS:
+        if marker not in content:
+            continue
+        for m in pattern.finditer(content):
+            matches.append(m.group(1))
+            spans.append(m.span())
+        if matches:
+            break
     
     # Also try to match JSON objects directly (without code block wrapper)
-    if not matches:
-        json_pattern = r'\{[^{}]*"name"\s*:\s*"[^"]+"\s*,\s*"arguments"\s*:\s*\{[^{}]*\}[^{}]*\}'
-        matches = re.findall(json_pattern, content, re.DOTALL)
+    if not matches and '"arguments"' in content:
+        matches = _JSON_TOOL_RE.findall(content)
     
     for i, match in enumerate(matches):
         try:
             match = match.strip()
             # Try to parse JSON
-            call_data = json.loads(match)
+            call_data = _json_loads_exact(match)
             if call_data.get("name"):
                 tool_calls.append({
                     "index": i,
-                    "id": f"call_{uuid.uuid4().hex[:8]}",
+                    "id": _next_tool_call_id(),
                     "type": "function",
                     "function": {
                         "name": call_data.get("name", ""),
-                        "arguments": json.dumps(call_data.get("arguments", {}), ensure_ascii=False)
+                        "arguments": _json_dumps(call_data.get("arguments", {}))
                     }
                 })
         except json.JSONDecodeError:
             continue
     
-    # Remove tool call sections
-    remaining = content
-    for pattern in patterns:
-        remaining = re.sub(pattern, '', remaining, flags=re.DOTALL)
-    remaining = remaining.strip()
+    # Remove tool call sections (the text between the matched blocks)
+    if spans:
+        parts = []
+        cursor = 0
+        for start, end in spans:
+            parts.append(content[cursor:start])
+            cursor = end
+        parts.append(content[cursor:])
+        remaining = "".join(parts).strip()
+    else:
+        remaining = content.strip()
     
     return tool_calls, remaining
 
 
+def _content_size(content) -> int:
+    """Characters of text a message contributes to the prompt (image parts are not counted)"""
+    if isinstance(content, str):
+        return len(content)
+    if isinstance(content, list):
+        return sum(len(item.get("text") or "") for item in content if item.get("type") == "text")
+    return 0
+
+
+def compact_history(messages: List[Dict], max_chars: int) -> List[Dict]:
+    """
+    Drop middle history messages until the replayed text fits max_chars
+    System messages, the first user message (carries the tools prompt) and everything from
+    the last user message on are always kept; the oldest of the rest are dropped first.
+    """
+    if max_chars <= 0:
+        return messages
+    sizes = [_content_size(m["content"]) for m in messages]
+    total = sum(sizes)
+    if total <= max_chars:
+        return messages
+    
+    first_user = next((i for i, m in enumerate(messages) if m["role"] == "user"), None)
+    last_user = next((i for i in range(len(messages) - 1, -1, -1) if messages[i]["role"] == "user"), None)
+    if first_user is None or last_user is None:
+        return messages
+    
+    dropped = set()
+    for i in range(first_user + 1, last_user):
+        if total <= max_chars:
+            break
+        if messages[i]["role"] != "system":
+            dropped.add(i)
+            total -= sizes[i]
+    if not dropped:
+        return messages
+    
+    print(f"[HISTORY] {len(dropped)} of {len(messages)} message(s) dropped to fit "
+          f"GEMINI_HISTORY_MAX_CHARS={max_chars} (history had {sum(sizes)} characters)")
+    # The notice is a system message: it is always kept and does not read as something the user said
+    marker_at = min(dropped)
+    compacted = []
+    for i, m in enumerate(messages):
+        if i == marker_at:
+            compacted.append({"role": "system", "content": f"[{len(dropped)} earlier messages of this conversation were omitted]"})
+        if i not in dropped:
+            compacted.append(m)
+    return compacted
+
+
+# (mtime_ns, size) of CONFIG_FILE as last loaded or saved, _config already reflects it
+_config_file_key = None
+
+
 def load_config():
     """
     Load configuration, priority:
     1. config_data.json (frontend saved configuration)
     2. config.py (local development configuration, as fallback only)
     """
-    global _config
+    global _config, _config_file_key
     loaded_from_json = False
     
-    # Load from JSON file first
-    if os.path.exists(CONFIG_FILE):
-        try:
-            with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-                saved = json.load(f)
-                if saved.get("SNLM0E") and saved.get("SECURE_1PSID"):
-                    _config.update(saved)
-                    loaded_from_json = True
-        except:
-            pass
+    # Load from JSON file first (skipped when unchanged since the last load/save)
+    try:
+        with open(CONFIG_FILE, "rb") as f:
+            st = os.fstat(f.fileno())
+            key = (st.st_mtime_ns, st.st_size)
+            if key == _config_file_key:
+                return
+            saved = _json_loads_exact(f.read())
+            if saved.get("SNLM0E") and saved.get("SECURE_1PSID"):
+                _config.update(saved)
+                loaded_from_json = True
+                _config_file_key = key
+    except:
+        pass
     
     # If JSON has no valid config, try loading from config.py
     if not loaded_from_json:
         try:
             import config
+            config_vars = vars(config)
             for key in _config:
-                if hasattr(config, key) and getattr(config, key):
-                    _config[key] = getattr(config, key)
+                value = config_vars.get(key)
+                if value:
+                    _config[key] = value
         except:
             pass
 
 
 def save_config():
-    with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-        json.dump(_config, f, indent=2, ensure_ascii=False)
+    """Write the config atomically (temp file + rename), readable only by the owner"""
+    global _config_file_key
+    data = _json_dumps_pretty(_config)
+    tmp_path = CONFIG_FILE + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+        if CONFIG_FSYNC:
+            os.fsync(fd)
+        st = os.fstat(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, CONFIG_FILE)
+    # Same condition as load_config: an incomplete file still falls back to config.py on load
+    _config_file_key = (st.st_mtime_ns, st.st_size) if _config.get("SNLM0E") and _config.get("SECURE_1PSID") else None
+
+
+# Optional cookies sent by the client after __Secure-1PSID: (cookie name, config field).
+# SAPISID is sent under both of its names.
+CLIENT_COOKIE_FIELDS = (
+    ("__Secure-1PSIDTS", "SECURE_1PSIDTS"),
+    ("SAPISID", "SAPISID"),
+    ("__Secure-1PAPISID", "SAPISID"),
+    ("SID", "SID"),
+    ("HSID", "HSID"),
+    ("SSID", "SSID"),
+    ("APISID", "APISID"),
+)
 
 
 def get_client():
@@ -382,24 +956,16 @@ def get_client():
     if _client is not None:
         return _client
     
-    cookies = f"__Secure-1PSID={_config['SECURE_1PSID']}"
-    if _config.get("SECURE_1PSIDTS"):
-        cookies += f"; __Secure-1PSIDTS={_config['SECURE_1PSIDTS']}"
-    if _config.get("SAPISID"):
-        cookies += f"; SAPISID={_config['SAPISID']}; __Secure-1PAPISID={_config['SAPISID']}"
-    if _config.get("SID"):
-        cookies += f"; SID={_config['SID']}"
-    if _config.get("HSID"):
-        cookies += f"; HSID={_config['HSID']}"
-    if _config.get("SSID"):
-        cookies += f"; SSID={_config['SSID']}"
-    if _config.get("APISID"):
-        cookies += f"; APISID={_config['APISID']}"
+    parts = [f"__Secure-1PSID={_config['SECURE_1PSID']}"]
+    for name, key in CLIENT_COOKIE_FIELDS:
+        value = _config.get(key)
+        if value:
+            parts.append(f"{name}={value}")
+    cookies = "; ".join(parts)
     
     # Build base URL for media files
     media_base_url = f"http://localhost:{PORT}"
     
-    from client import GeminiClient
     _client = GeminiClient(
         secure_1psid=_config["SECURE_1PSID"],
         snlm0e=_config["SNLM0E"],
@@ -408,6 +974,8 @@ def get_client():
         model_ids=_config.get("MODEL_IDS") or DEFAULT_MODEL_IDS,
         debug=True,
         media_base_url=media_base_url,
+        track_history=False,  # Session is reset per request, history is never read
+        on_media_saved=_register_media,
     )
     return _client
 
@@ -743,62 +1311,99 @@ for chunk in stream:
             'APISID': 'APISID'
         };
         
-        // Parse Cookie string
+        // ASCII whitespace: space, tab, LF, VT, FF, CR
+        function isCookieSpace(c) {
+            return c === 32 || (c >= 9 && c <= 13);
+        }
+        
+        // Parse Cookie string: one forward scan by index, only known cookie names get their value sliced
         function parseCookie(cookieStr) {
             const result = {};
             if (!cookieStr) return result;
             
-            cookieStr.split(';').forEach(item => {
-                const trimmed = item.trim();
-                const eqIndex = trimmed.indexOf('=');
-                if (eqIndex > 0) {
-                    const key = trimmed.substring(0, eqIndex).trim();
-                    const value = trimmed.substring(eqIndex + 1).trim();
-                    if (cookieFields[key]) {
-                        result[cookieFields[key]] = value;
+            const len = cookieStr.length;
+            let pos = 0;
+            let eqIndex = -1;
+            while (pos < len) {
+                let end = cookieStr.indexOf(';', pos);
+                if (end === -1) end = len;
+                // '=' found for an earlier item may belong to a later one, search again only when passed
+                if (eqIndex < pos) {
+                    eqIndex = cookieStr.indexOf('=', pos);
+                    if (eqIndex === -1) eqIndex = len;
+                }
+                if (eqIndex < end) {
+                    let keyStart = pos, keyEnd = eqIndex;
+                    while (keyStart < keyEnd && isCookieSpace(cookieStr.charCodeAt(keyStart))) keyStart++;
+                    while (keyEnd > keyStart && isCookieSpace(cookieStr.charCodeAt(keyEnd - 1))) keyEnd--;
+                    const field = keyEnd > keyStart ? cookieFields[cookieStr.slice(keyStart, keyEnd)] : undefined;
+                    // First occurrence wins (the browser lists the most specific cookie first)
+                    if (field && result[field] === undefined) {
+                        let valueStart = eqIndex + 1, valueEnd = end;
+                        while (valueStart < valueEnd && isCookieSpace(cookieStr.charCodeAt(valueStart))) valueStart++;
+                        while (valueEnd > valueStart && isCookieSpace(cookieStr.charCodeAt(valueEnd - 1))) valueEnd--;
+                        result[field] = cookieStr.slice(valueStart, valueEnd);
                     }
                 }
-            });
+                pos = end + 1;
+            }
             return result;
         }
         
-        // Display parsed results
+        // Fields shown under the cookie box: [parsed key, cookie name], built once
+        const parsedFieldNames = [
+            ['SECURE_1PSID', '__Secure-1PSID'],
+            ['SECURE_1PSIDTS', '__Secure-1PSIDTS'],
+            ['SAPISID', 'SAPISID'],
+            ['SID', 'SID'],
+            ['HSID', 'HSID'],
+            ['SSID', 'SSID'],
+            ['APISID', 'APISID']
+        ];
+        
+        const htmlEscapes = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'};
+        function escapeHtml(text) {
+            return text.replace(/[&<>"']/g, (c) => htmlEscapes[c]);
+        }
+        
+        // Display parsed results (values come from the pasted cookie, so they are escaped)
         function showParsedFields(parsed) {
             const container = document.getElementById('parsedFields');
             const infoBox = document.getElementById('parsedInfo');
             
-            const fieldNames = {
-                'SECURE_1PSID': '__Secure-1PSID',
-                'SECURE_1PSIDTS': '__Secure-1PSIDTS',
-                'SAPISID': 'SAPISID',
-                'SID': 'SID',
-                'HSID': 'HSID',
-                'SSID': 'SSID',
-                'APISID': 'APISID'
-            };
-            
-            let html = '';
-            let hasFields = false;
-            for (const [key, name] of Object.entries(fieldNames)) {
+            const parts = [];
+            for (const [key, name] of parsedFieldNames) {
                 if (parsed[key]) {
-                    hasFields = true;
                     const shortValue = parsed[key].length > 30 ? parsed[key].substring(0, 30) + '...' : parsed[key];
-                    html += '<div class="item">' + name + ': <span>' + shortValue + '</span></div>';
+                    parts.push('<div class="item">', name, ': <span>', escapeHtml(shortValue), '</span></div>');
                 }
             }
             
-            if (hasFields) {
-                container.innerHTML = html;
+            if (parts.length) {
+                const html = parts.join('');
+                // Skip the DOM rewrite (and reflow) when the rendered fields did not change
+                if (html !== lastParsedHtml) {
+                    container.innerHTML = html;
+                    lastParsedHtml = html;
+                }
                 infoBox.style.display = 'block';
             } else {
                 infoBox.style.display = 'none';
             }
         }
         
-        // Listen to Cookie input
+        // Listen to Cookie input (debounced: a paste or typing burst is parsed once)
+        let cookieDebounceTimer = null;
+        let lastParsedCookie = '';
+        let lastParsedHtml = '';
         document.getElementById('FULL_COOKIE').addEventListener('input', (e) => {
-            const parsed = parseCookie(e.target.value);
-            showParsedFields(parsed);
+            clearTimeout(cookieDebounceTimer);
+            cookieDebounceTimer = setTimeout(() => {
+                const value = e.target.value;
+                if (value === lastParsedCookie) return;
+                lastParsedCookie = value;
+                showParsedFields(parseCookie(value));
+            }, 120);
         });
         
         // Load configuration
@@ -822,18 +1427,15 @@ for chunk in stream:
         
         document.getElementById('configForm').addEventListener('submit', async (e) => {
             e.preventDefault();
-            const formData = new FormData(e.target);
-            const data = Object.fromEntries(formData.entries());
-            
-            // Build model IDs object
-            data.MODEL_IDS = {
-                flash: data.MODEL_ID_FLASH || '',
-                pro: data.MODEL_ID_PRO || '',
-                thinking: data.MODEL_ID_THINKING || ''
+            // Read the four inputs directly, model IDs are sent as one object
+            const data = {
+                FULL_COOKIE: document.getElementById('FULL_COOKIE').value,
+                MODEL_IDS: {
+                    flash: document.getElementById('MODEL_ID_FLASH').value,
+                    pro: document.getElementById('MODEL_ID_PRO').value,
+                    thinking: document.getElementById('MODEL_ID_THINKING').value
+                }
             };
-            delete data.MODEL_ID_FLASH;
-            delete data.MODEL_ID_PRO;
-            delete data.MODEL_ID_THINKING;
             
             const statusEl = document.getElementById('status');
             statusEl.className = 'status';
@@ -883,9 +1485,51 @@ for chunk in stream:
 </html>'''
 
 
+# Admin pages only depend on module constants (API_KEY, PORT): render, encode and gzip once
+_LOGIN_HTML = get_login_html().encode("utf-8")
+_ADMIN_HTML = get_admin_html().encode("utf-8")
+_LOGIN_HTML_GZ = gzip.compress(_LOGIN_HTML, compresslevel=9)
+_ADMIN_HTML_GZ = gzip.compress(_ADMIN_HTML, compresslevel=9)
+# Strong ETags per page (the gzip representation gets its own tag)
+_LOGIN_HTML_ETAG = '"%s"' % hashlib.sha256(_LOGIN_HTML).hexdigest()[:16]
+_ADMIN_HTML_ETAG = '"%s"' % hashlib.sha256(_ADMIN_HTML).hexdigest()[:16]
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows gzip (listed, and not with q=0)"""
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        if coding.strip().lower() != "gzip":
+            continue
+        name, _, value = params.partition("=")
+        if name.strip().lower() != "q":
+            return True
+        try:
+            return float(value) > 0
+        except ValueError:
+            return False
+    return False
+
+
+def _html_page(request: Request, html: bytes, html_gz: bytes, etag: str,
+               cache_control: str = "private, no-cache") -> Response:
+    """Serve the pre-compressed page when the client accepts gzip, 304 if the browser copy is current"""
+    gzipped = _accepts_gzip(request.headers.get("accept-encoding", ""))
+    if gzipped:
+        etag = etag[:-1] + '-gz"'
+    headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": cache_control}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+        return HTMLResponse(content=html_gz, headers=headers)
+    return HTMLResponse(content=html, headers=headers)
+
+
 @app.get("/admin/login", response_class=HTMLResponse)
-async def admin_login_page():
-    return get_login_html()
+async def admin_login_page(request: Request):
+    # The login page holds no secrets and only changes with a restart
+    return _html_page(request, _LOGIN_HTML, _LOGIN_HTML_GZ, _LOGIN_HTML_ETAG, "public, max-age=300")
 
 
 @app.post("/admin/login")
@@ -894,10 +1538,10 @@ async def admin_login(request: Request):
     username = data.get("username", "")
     password = data.get("password", "")
     
-    if username == ADMIN_USERNAME and password == ADMIN_PASSWORD:
+    # Check both fields so timing does not reveal which one was wrong
+    if _secret_equals(username, ADMIN_USERNAME) & _secret_equals(password, ADMIN_PASSWORD):
         token = generate_session_token()
-        _admin_sessions.add(token)
-        response = JSONResponse({"success": True, "message": "Login successful"})
+        response = FastJSONResponse({"success": True, "message": "Login successful"})
         response.set_cookie(key="admin_session", value=token, httponly=True, max_age=86400)
         return response
     else:
@@ -907,8 +1551,8 @@ async def admin_login(request: Request):
 @app.get("/admin/logout")
 async def admin_logout(request: Request):
     token = request.cookies.get("admin_session")
-    if token and token in _admin_sessions:
-        _admin_sessions.discard(token)
+    if token:
+        revoke_session_token(token)
     response = RedirectResponse(url="/admin/login", status_code=302)
     response.delete_cookie("admin_session")
     return response
@@ -918,7 +1562,8 @@ async def admin_logout(request: Request):
 async def admin_page(request: Request):
     if not verify_admin_session(request):
         return RedirectResponse(url="/admin/login", status_code=302)
-    return get_admin_html()
+    # Browsers must revalidate (the admin page embeds the API key), which costs a 304 when unchanged
+    return _html_page(request, _ADMIN_HTML, _ADMIN_HTML_GZ, _ADMIN_HTML_ETAG)
 
 
 @app.post("/admin/save")
@@ -930,9 +1575,13 @@ async def admin_save(request: Request):
     data = await request.json()
     
     # Process complete Cookie string, remove leading/trailing spaces
-    full_cookie = data.get("FULL_COOKIE", "").strip()
+    full_cookie = data.get("FULL_COOKIE", "")
+    full_cookie = full_cookie.strip() if isinstance(full_cookie, str) else ""
     if not full_cookie:
         return {"success": False, "message": "Cookie is required"}
+    # Bound the work done on the input (parsing, hashing, sending it to Google)
+    if len(full_cookie) > COOKIE_MAX_LENGTH:
+        return {"success": False, "message": f"Cookie is too long (max {COOKIE_MAX_LENGTH} characters)"}
     
     # Parse Cookie string
     parsed = parse_cookie_string(full_cookie)
@@ -940,8 +1589,8 @@ async def admin_save(request: Request):
     if not parsed.get("SECURE_1PSID"):
         return {"success": False, "message": "__Secure-1PSID field not found in Cookie, please ensure you copied the complete Cookie"}
     
-    # Automatically fetch SNLM0E and PUSH_ID from page
-    tokens = fetch_tokens_from_page(full_cookie)
+    # Automatically fetch SNLM0E and PUSH_ID from page (X-Force-Refresh skips the cache)
+    tokens = await run_in_threadpool(fetch_tokens_cached, full_cookie, bool(request.headers.get("x-force-refresh")))
     
     if not tokens.get("snlm0e"):
         return {"success": False, "message": "Unable to automatically fetch AT Token, please check if Cookie is valid or expired"}
@@ -952,7 +1601,7 @@ async def admin_save(request: Request):
     _config["PUSH_ID"] = tokens.get("push_id", "")
     
     # Update fields from parsed results
-    for field in ["SECURE_1PSID", "SECURE_1PSIDTS", "SAPISID", "SID", "HSID", "SSID", "APISID"]:
+    for field in COOKIE_CONFIG_FIELDS:
         _config[field] = parsed.get(field, "")
     
     # Use automatically fetched models list, use default if fetch fails
@@ -972,16 +1621,15 @@ async def admin_save(request: Request):
         if model_ids.get("thinking"):
             _config["MODEL_IDS"]["thinking"] = model_ids["thinking"]
     
-    save_config()
+    await run_in_threadpool(save_config)  # Blocking write + fsync
     _client = None
     
     # Build result information
-    parsed_fields = [k for k in ["SECURE_1PSID", "SECURE_1PSIDTS", "SAPISID", "SID", "HSID", "SSID", "APISID"] if parsed.get(k)]
     push_id_msg = f", PUSH_ID ✓" if tokens.get("push_id") else ", PUSH_ID ✗ (Image feature unavailable)"
     models_msg = f", {len(_config['MODELS'])} models" if _config.get("MODELS") else ""
     
     try:
-        get_client()
+        await run_in_threadpool(get_client)
         return {
             "success": True, 
             "message": f"Configuration saved and verified successfully! AT Token ✓{push_id_msg}{models_msg}",
@@ -1013,6 +1661,15 @@ class ToolCall(BaseModel):
     type: str = "function"
     function: ToolCallFunction
 
+# Roles whose messages carry tool results back to the model
+_TOOL_RESULT_ROLES = frozenset(("tool", "function"))
+
+# Constant tails of SSE chunks (everything after '"delta":'), only the content delta is encoded per request
+_SSE_DELTA_TAIL = b',"finish_reason":null}]}\n\n'
+_SSE_ROLE_TAIL = b'{"role":"assistant"}' + _SSE_DELTA_TAIL
+_SSE_FINISH_TAILS = {reason: b'{},"finish_reason":"%s"}]}\n\n' % reason.encode() for reason in ("stop", "tool_calls")}
+_SSE_DONE = b"data: [DONE]\n\n"
+
 class ChatMessage(BaseModel):
     role: str
     content: Optional[Union[str, List[Dict[str, Any]]]] = None  # Optional for assistant messages with tool_calls
@@ -1020,8 +1677,7 @@ class ChatMessage(BaseModel):
     tool_call_id: Optional[str] = None  # Required for tool results from opencode
     tool_calls: Optional[List[ToolCall]] = None  # For assistant messages that invoke tools
     
-    class Config:
-        extra = "ignore"
+    model_config = ConfigDict(extra="ignore")
 
 
 class FunctionDefinition(BaseModel):
@@ -1050,37 +1706,56 @@ class ChatCompletionRequest(BaseModel):
     n: Optional[int] = None
     user: Optional[str] = None
     
-    class Config:
-        extra = "ignore"  # Ignore undefined extra fields
+    model_config = ConfigDict(extra="ignore")  # Ignore undefined extra fields
 
 
-class ChatCompletionChoice(BaseModel):
-    index: int
-    message: Dict[str, Any]
-    finish_reason: str
+def verify_api_key(authorization: str = Header(None)):
+    if not API_KEY:
+        return True
+    if not authorization or not authorization.startswith("Bearer ") or not _secret_equals(authorization[7:], API_KEY):
+        raise HTTPException(status_code=401, detail="Invalid API key")
+    return True
 
 
-class Usage(BaseModel):
-    prompt_tokens: int
-    completion_tokens: int
-    total_tokens: int
+def _parse_chat_request(raw_body: bytes) -> tuple:
+    """
+    Decode the request body once and validate it
+    Returns (ChatCompletionRequest, decoded body). Errors are raised like FastAPI's own body validation (422).
+    """
+    if not raw_body:
+        raise RequestValidationError([{"type": "missing", "loc": ("body",), "msg": "Field required", "input": None}])
+    try:
+        body = _json_loads_exact(raw_body)
+    except ValueError as e:
+        raise RequestValidationError([{
+            "type": "json_invalid", "loc": ("body", getattr(e, "pos", 0)), "msg": "JSON decode error",
+            "input": {}, "ctx": {"error": getattr(e, "msg", str(e))},
+        }])
+    try:
+        return ChatCompletionRequest.model_validate(body), body
+    except ValidationError as e:
+        raise RequestValidationError([{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)])
 
 
-class ChatCompletionResponse(BaseModel):
-    id: str
-    object: str = "chat.completion"
-    created: int
-    model: str
-    choices: List[ChatCompletionChoice]
-    usage: Usage
+_fastapi_openapi = app.openapi
 
 
-def verify_api_key(authorization: str = Header(None)):
-    if not API_KEY:
-        return True
-    if not authorization or not authorization.startswith("Bearer ") or authorization[7:] != API_KEY:
-        raise HTTPException(status_code=401, detail="Invalid API key")
-    return True
+def _openapi_with_chat_request() -> dict:
+    """FastAPI's OpenAPI schema plus the chat completion request body, which the route decodes itself"""
+    if app.openapi_schema is None:
+        schema = _fastapi_openapi()
+        body_schema = ChatCompletionRequest.model_json_schema(ref_template="#/components/schemas/{model}")
+        components = schema.setdefault("components", {}).setdefault("schemas", {})
+        components.update(body_schema.pop("$defs", {}))
+        components["ChatCompletionRequest"] = body_schema
+        schema["paths"]["/v1/chat/completions"]["post"]["requestBody"] = {
+            "required": True,
+            "content": {"application/json": {"schema": {"$ref": "#/components/schemas/ChatCompletionRequest"}}},
+        }
+    return app.openapi_schema
+
+
+app.openapi = _openapi_with_chat_request
 
 
 @app.get("/")
@@ -1088,110 +1763,125 @@ async def root():
     return RedirectResponse(url="/admin")
 
 
+# Serialized /v1/models body for the models list it was built from, rebuilt when the list changes
+_models_cache: tuple = ((), b"")
+
+
 @app.get("/v1/models")
 async def list_models(authorization: str = Header(None)):
+    global _models_cache
     verify_api_key(authorization)
-    models = _config.get("MODELS", DEFAULT_MODELS)
-    created = int(time.time())
+    models = tuple(_config.get("MODELS", DEFAULT_MODELS))
+    if models != _models_cache[0] or not _models_cache[1]:
+        created = int(time.time())
+        body = _json_dumps({
+            "object": "list",
+            "data": [{"id": m, "object": "model", "created": created, "owned_by": "google"} for m in models]
+        }).encode("utf-8")
+        _models_cache = (models, body)
+    return Response(
+        content=_models_cache[1],
+        media_type="application/json",
+        headers={"Cache-Control": "private, max-age=30"},
+    )
+
+
+def _build_request_log(request: "ChatCompletionRequest", body: dict) -> dict:
+    """Request parameters as sent, with image URLs (often whole data URIs) cut to a preview"""
+    messages = []
+    for m in body["messages"]:
+        content = m.get("content")
+        if isinstance(content, list):
+            content = [
+                _image_url_preview(item) if isinstance(item, dict) and item.get("type") == "image_url" else item
+                for item in content
+            ]
+        messages.append({"role": m.get("role"), "content": content})
     return {
-        "object": "list",
-        "data": [{"id": m, "object": "model", "created": created, "owned_by": "google"} for m in models]
+        "model": request.model,
+        "stream": request.stream,
+        "messages": messages,
+        "tools": body.get("tools")
     }
 
 
-def log_api_call(request_data: dict, response_data: dict, error: str = None):
-    """Log API call to file"""
-    import datetime
-    log_entry = {
-        "timestamp": datetime.datetime.now().isoformat(),
+def _image_url_preview(item: dict) -> dict:
+    img_url = item.get("image_url", {})
+    url = img_url.get("url", "") if isinstance(img_url, dict) else str(img_url)
+    return {"type": "image_url", "url_preview": url[:100] + "..." if len(url) > 100 else url}
+
+
+def log_api_call(request_data: Optional[dict], response_data: dict, error: str = None):
+    """Log API call to file (queued, written by the client's background log writer)"""
+    if not API_LOG_ENABLED:
+        return
+    enqueue_log({
+        "timestamp": datetime.now().isoformat(),
         "request": request_data,
         "response": response_data,
         "error": error
-    }
-    try:
-        with open("logs_api.log", "a", encoding="utf-8") as f:
-            f.write(json.dumps(log_entry, ensure_ascii=False, indent=2) + "\n---\n")
-    except Exception as e:
-        print(f"[LOG ERROR] 写入日志失败: {e}")
+    })
 
 
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest, authorization: str = Header(None)):
+async def chat_completions(raw_request: Request, authorization: str = Header(None)):
     global _last_request_time
 
-    # debug raw request and all headers into a file log 
-    with open("logs_raw_requests.log", "a", encoding="utf-8") as log_file:
-        log_file.write(json.dumps(request.model_dump(), ensure_ascii=False, indent=2))
-        log_file.write("\n---\n")
+    # The body is decoded by us rather than by FastAPI: once, and kept for the logs and tool schemas
+    raw_body = await raw_request.body()
+    request, body = _parse_chat_request(raw_body)
     
-    # Log tool responses specifically for debugging
-    for msg in request.messages:
-        if hasattr(msg, 'role') and msg.role == 'tool':
+    # debug raw request into a file log
+    enqueue_log(raw_body, RAW_REQUEST_LOG_FILE)
+    
+    verify_api_key(authorization)
+    
+    # Log tool responses specifically for debugging. Only the results after the last
+    # assistant message are new, earlier ones were logged with previous requests
+    if DEBUG_MSG_LOG:
+        new_tool_results = []
+        for msg in reversed(request.messages):
+            if msg.role == 'assistant':
+                break
+            if msg.role == 'tool':
+                new_tool_results.append(msg)
+        for msg in reversed(new_tool_results):
             print(f"[TOOL_RESPONSE] tool_call_id: {msg.tool_call_id}")
             print(f"[TOOL_RESPONSE] content length: {len(msg.content) if msg.content else 0}")
             print(f"[TOOL_RESPONSE] content: {msg.content[:500] if msg.content else 'None'}...")
-
-    verify_api_key(authorization)
     
-    # Log request parameters (truncate image content)
-    request_log = {
-        "model": request.model,
-        "stream": request.stream,
-        "messages": [],
-        "tools": [t.model_dump() for t in request.tools] if request.tools else None
-    }
-
-    for m in request.messages:
-        msg_log = {"role": m.role}
-        if isinstance(m.content, list):
-            content_log = []
-            for item in m.content:
-                if item.get("type") == "image_url":
-                    img_url = item.get("image_url", {})
-                    if isinstance(img_url, dict):
-                        url = img_url.get("url", "")
-                    else:
-                        url = str(img_url)
-                    content_log.append({"type": "image_url", "url_preview": url[:100] + "..." if len(url) > 100 else url})
-                else:
-                    content_log.append(item)
-            msg_log["content"] = content_log
-        else:
-            msg_log["content"] = m.content
-        request_log["messages"].append(msg_log)
+    request_log = _build_request_log(request, body) if API_LOG_ENABLED else None
     
     try:
         client = get_client()
         
-        # Always reset session - external apps will send full message history
-        client.reset()
-        
         # Send all messages to establish context
-        messages = [{"role": m.role if hasattr(m, 'role') else m.get('role', ''),
-                    "content": m.content if hasattr(m, 'content') else m.get('content', '')} 
-                   for m in request.messages]
-        print(f"[SESSION] New session created. Sending {len(messages)} message(s) from history")
-        
-        # Detect if it's a tool call continuation (for logging purposes)
-        last_msg = request.messages[-1] if request.messages else None
-        last_role = (last_msg.role if hasattr(last_msg, 'role') else last_msg.get('role', '')) if last_msg else ''
-        is_tool_continuation = last_role in ('tool', 'function')
+        messages = compact_history([{"role": m.role, "content": m.content} for m in request.messages], HISTORY_MAX_CHARS)
+        if DEBUG_MSG_LOG:
+            # Detect if it's a tool call continuation (for logging purposes)
+            last_role = request.messages[-1].role if request.messages else ''
+            is_tool_continuation = last_role in _TOOL_RESULT_ROLES
+            print(f"[SESSION] New session created. Sending {len(messages)} message(s) from history"
+                  f"{' (tool continuation)' if is_tool_continuation else ''}")
         
         # If there are tools, add tool prompt to the first user message
         if request.tools and len(messages) > 0:
-            tools_prompt = build_tools_prompt([t.model_dump() for t in request.tools])
-            # Find the first user message to add tools context
-            for i in range(len(messages)):
-                if messages[i]["role"] == "user":
-                    original = messages[i]["content"]
-                    if isinstance(original, str):
-                        messages[i]["content"] = tools_prompt + original
-                    break
+            tools_prompt = build_tools_prompt_cached(body["tools"], request.tools)
+            # Find the first user message to add tools context (skipped if the client sent it back already)
+            first_user = next((m for m in messages if m["role"] == "user"), None)
+            if (first_user is not None and isinstance(first_user["content"], str)
+                    and not first_user["content"].startswith(tools_prompt)):
+                first_user["content"] = tools_prompt + first_user["content"]
         
-        response = client.chat(messages=messages, model=request.model)
+        # Always reset session - external apps will send full message history.
+        # Run the blocking call off the event loop, bounded by the upstream semaphore
+        async with _upstream_sem:
+            await _rpm_limiter.wait()
+            client.reset()
+            response = await run_in_threadpool(client.chat, messages=messages, model=request.model)
         
         reply_content = response.choices[0].message.content
-        completion_id = f"chatcmpl-{uuid.uuid4().hex[:8]}"
+        completion_id = f"chatcmpl-{secrets.token_hex(4)}"
         created_time = int(time.time())
         
         # Parse tool calls
@@ -1202,62 +1892,30 @@ async def chat_completions(request: ChatCompletionRequest, authorization: str =
         
         # Handle streaming response
         if request.stream:
+            # Fields shared by every chunk are encoded once, only the content delta is encoded
+            # per reply. Frames are bytes so StreamingResponse sends them without re-encoding.
+            chunk_prefix = (
+                f'data: {{"id":{_json_dumps(completion_id)},"object":"chat.completion.chunk",'
+                f'"created":{created_time},"model":{_json_dumps(request.model)},"choices":[{{"index":0,"delta":'
+            ).encode("utf-8")
+            
+            # The reply is already complete: all tool calls go in one delta (each keeps its index)
+            delta = {"tool_calls": tool_calls} if tool_calls else {"content": final_content}
+            frames = [
+                chunk_prefix + _SSE_ROLE_TAIL,
+                b"".join((chunk_prefix, _json_dumps_bytes(delta), _SSE_DELTA_TAIL)),
+                chunk_prefix + _SSE_FINISH_TAILS["tool_calls" if tool_calls else "stop"],
+                _SSE_DONE,
+            ]
+            
             async def generate_stream():
-                chunk_data = {
-                    "id": completion_id,
-                    "object": "chat.completion.chunk",
-                    "created": created_time,
-                    "model": request.model,
-                    "choices": [{
-                        "index": 0,
-                        "delta": {"role": "assistant"},
-                        "finish_reason": None
-                    }]
-                }
-                yield f"data: {json.dumps(chunk_data)}\n\n"
-                
-                if tool_calls:
-                    # Stream return tool calls
-                    for tc in tool_calls:
-                        chunk_data = {
-                            "id": completion_id,
-                            "object": "chat.completion.chunk",
-                            "created": created_time,
-                            "model": request.model,
-                            "choices": [{
-                                "index": 0,
-                                "delta": {"tool_calls": [tc]},
-                                "finish_reason": None
-                            }]
-                        }
-                        yield f"data: {json.dumps(chunk_data)}\n\n"
+                # Small replies are sent in a single write, larger ones event by event
+                body = b"".join(frames)
+                if len(body) <= SSE_COALESCE_MAX_SIZE:
+                    yield body
                 else:
-                    chunk_data = {
-                        "id": completion_id,
-                        "object": "chat.completion.chunk",
-                        "created": created_time,
-                        "model": request.model,
-                        "choices": [{
-                            "index": 0,
-                            "delta": {"content": final_content},
-                            "finish_reason": None
-                        }]
-                    }
-                    yield f"data: {json.dumps(chunk_data)}\n\n"
-                
-                chunk_data = {
-                    "id": completion_id,
-                    "object": "chat.completion.chunk",
-                    "created": created_time,
-                    "model": request.model,
-                    "choices": [{
-                        "index": 0,
-                        "delta": {},
-                        "finish_reason": "tool_calls" if tool_calls else "stop"
-                    }]
-                }
-                yield f"data: {json.dumps(chunk_data)}\n\n"
-                yield "data: [DONE]\n\n"
+                    for frame in frames:
+                        yield frame
             
             return StreamingResponse(
                 generate_stream(), 
@@ -1279,18 +1937,24 @@ async def chat_completions(request: ChatCompletionRequest, authorization: str =
             response_message["content"] = final_content
             finish_reason = "stop"
         
-        response_data = ChatCompletionResponse(
-            id=completion_id,
-            created=created_time,
-            model=request.model,
-            choices=[ChatCompletionChoice(index=0, message=response_message, finish_reason=finish_reason)],
-            usage=Usage(prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens, total_tokens=response.usage.total_tokens)
-        )
+        usage = response.usage
+        response_data = {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created_time,
+            "model": request.model,
+            "choices": [{"index": 0, "message": response_message, "finish_reason": finish_reason}],
+            "usage": {
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+                "total_tokens": usage.total_tokens,
+            },
+        }
         
-        log_api_call(request_log, response_data.model_dump())
+        log_api_call(request_log, response_data)
         
-        return JSONResponse(
-            content=response_data.model_dump(),
+        return FastJSONResponse(
+            content=response_data,
             headers={
                 "Cache-Control": "no-cache",
                 "X-Request-Id": completion_id,
@@ -1298,8 +1962,11 @@ async def chat_completions(request: ChatCompletionRequest, authorization: str =
         )
     except HTTPException:
         raise
+    except UpstreamUnavailableError as e:
+        # Circuit breaker is open, fail fast without a traceback
+        log_api_call(request_log, None, error=str(e))
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
-        import traceback
         error_msg = str(e)
         print(f"[ERROR] Chat error: {error_msg}")
         traceback.print_exc()
@@ -0,0 +1,39 @@
+"""Admin session cookie checks (run with: python -m unittest discover tests)"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.testclient import TestClient
+
+import server
+
+
+class AdminSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.client = TestClient(server.app)
+
+    def get(self, path, cookie):
+        headers = {"Cookie": ("admin_session=" + cookie).encode("utf-8")}
+        return self.client.get(path, headers=headers, follow_redirects=False)
+
+    def test_malformed_cookie_is_rejected_not_500(self):
+        for cookie in ("1.b.\xe9", "\xb2.b.x", "1.\xe9.x", "garbage", "1..x"):
+            with self.subTest(cookie=cookie):
+                self.assertIsNone(server._session_expiry(cookie))
+                self.assertEqual(self.get("/admin", cookie).status_code, 302)
+                self.assertEqual(self.get("/admin/config", cookie).status_code, 401)
+                self.assertEqual(self.get("/admin/logout", cookie).status_code, 302)
+
+    def test_signed_token_is_accepted(self):
+        token = server.generate_session_token()
+        self.assertEqual(self.get("/admin", token).status_code, 200)
+
+    def test_tampered_token_is_rejected(self):
+        token = server.generate_session_token()
+        self.assertEqual(self.get("/admin", token[:-1] + ("0" if token[-1] != "0" else "1")).status_code, 302)
+
+
+if __name__ == "__main__":
+    unittest.main()
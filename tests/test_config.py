@@ -0,0 +1,44 @@
+"""Config file save/load checks (run with: python -m unittest discover tests)"""
+import copy
+import os
+import sys
+import tempfile
+import unittest
+
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+class ConfigFileTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = (server.CONFIG_FILE, copy.deepcopy(server._config), server._config_file_key)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        server.CONFIG_FILE = os.path.join(self.tmpdir.name, "config_data.json")
+
+    def tearDown(self):
+        server.CONFIG_FILE, config, server._config_file_key = self.saved
+        server._config.clear()
+        server._config.update(config)
+        self.tmpdir.cleanup()
+
+    def test_big_integer_model_id_round_trips(self):
+        server._config.update(SNLM0E="x", SECURE_1PSID="y", MODEL_IDS={"flash": 123456789012345678901234567})
+        server.save_config()
+        server._config["MODEL_IDS"] = {}
+        server._config_file_key = None
+        server.load_config()
+        self.assertEqual(server._config["MODEL_IDS"], {"flash": 123456789012345678901234567})
+
+    def test_admin_config_renders_big_integer(self):
+        server._config["MODEL_IDS"] = {"flash": 123456789012345678901234567}
+        headers = {"Cookie": "admin_session=" + server.generate_session_token()}
+        response = TestClient(server.app).get("/admin/config", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["MODEL_IDS"], {"flash": 123456789012345678901234567})
+
+
+if __name__ == "__main__":
+    unittest.main()
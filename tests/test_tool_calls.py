@@ -0,0 +1,32 @@
+"""Tool call parsing checks (run with: python -m unittest discover tests)"""
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+class ParseToolCallsTest(unittest.TestCase):
+    def parse_arguments(self, body):
+        tool_calls, _ = server.parse_tool_calls("```tool_call\n" + body + "\n```")
+        self.assertEqual(len(tool_calls), 1)
+        return tool_calls[0]["function"]["arguments"]
+
+    def test_big_integer_argument_is_kept_exact(self):
+        arguments = self.parse_arguments('{"name":"lookup","arguments":{"order_id":123456789012345678901234567}}')
+        self.assertEqual(json.loads(arguments), {"order_id": 123456789012345678901234567})
+
+    def test_lone_surrogate_escape_is_not_dropped(self):
+        arguments = self.parse_arguments('{"name":"echo","arguments":{"text":"\\ud83d"}}')
+        self.assertEqual(json.loads(arguments), {"text": "\ud83d"})
+
+    def test_plain_call(self):
+        arguments = self.parse_arguments('{"name":"f","arguments":{"a":1,"b":"x"}}')
+        self.assertEqual(json.loads(arguments), {"a": 1, "b": "x"})
+
+
+if __name__ == "__main__":
+    unittest.main()